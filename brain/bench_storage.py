@@ -0,0 +1,100 @@
+# brain/bench_storage.py
+# Usage: python brain/bench_storage.py [--notes 5000] [--readers 8] [--seconds 5]
+# Measures read latency while a writer commits continuously, once per journal mode, each on a scratch
+# database (never the real vault) with fixed vectors instead of the embedding provider.
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import threading
+import subprocess
+
+def run(args):
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="second-brain-bench-")
+    import numpy as np
+    import storage
+
+    rng = np.random.default_rng(0)
+    words = ["alpha", "beta", "gamma", "delta", "email", "meeting", "project", "recipe", "travel", "budget"]
+    with storage.writer() as conn:
+        for i in range(args.notes):
+            body = " ".join(rng.choice(words, 40))
+            conn.execute("INSERT INTO notes(parent_id, body, ts, emb, tags, is_favorite) VALUES(?,?,?,?,?,?)",
+                         (None, body, time.time() - i, rng.random(64, dtype="float32").tobytes(),
+                          words[i % len(words)], int(i % 7 == 0)))
+    stop = threading.Event()
+    latencies = [[] for _ in range(args.readers)]
+    writes = [0]
+
+    def write_loop():
+        i = 0
+        while not stop.is_set():
+            with storage.writer() as conn:
+                conn.execute("INSERT INTO notes(parent_id, body, ts, emb, tags, is_favorite) VALUES(?,?,?,?,?,0)",
+                             (None, f"bench write {i} " + " ".join(rng.choice(words, 40)), time.time(),
+                              rng.random(64, dtype="float32").tobytes(), "bench"))
+            i += 1
+            writes[0] = i
+
+    def read_loop(out):
+        # These threads never call get_conn(), so their reads borrow pooled connections
+        queries = [
+            lambda: storage.filter_notes("meeting", limit=50),
+            lambda: storage.filter_notes(tags="email", limit=50),
+            lambda: storage.get_favorite_notes(limit=50),
+            lambda: storage.get_note(1),
+        ]
+        i = 0
+        while not stop.is_set():
+            t = time.perf_counter()
+            queries[i % len(queries)]()
+            out.append(time.perf_counter() - t)
+            i += 1
+
+    threads = [threading.Thread(target=write_loop)] + [threading.Thread(target=read_loop, args=(out,))
+                                                      for out in latencies]
+    for t in threads:
+        t.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    ms = np.array([x for out in latencies for x in out]) * 1000
+    return {
+        "journal_mode": storage.DB_PRAGMAS["journal_mode"],
+        "reads": len(ms),
+        "writes": writes[0],
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+        "max_ms": round(float(ms.max()), 2),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Second Brain storage read latency under concurrent writes")
+    parser.add_argument("--notes", type=int, default=5000, help="notes seeded before measuring")
+    parser.add_argument("--readers", type=int, default=8, help="concurrent reader threads")
+    parser.add_argument("--seconds", type=float, default=5.0, help="measurement window per mode")
+    parser.add_argument("--modes", default="DELETE,WAL", help="journal modes to compare")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(run(args)))
+        return
+
+    # storage reads its settings at import, so each mode runs in its own process
+    print(f"{'mode':<8} {'reads':>8} {'writes':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for mode in args.modes.split(","):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--notes", str(args.notes), "--readers", str(args.readers),
+             "--seconds", str(args.seconds)],
+            env=dict(os.environ, SECOND_BRAIN_JOURNAL_MODE=mode), capture_output=True, text=True, check=True)
+        r = json.loads(out.stdout.strip().splitlines()[-1])
+        print(f"{r['journal_mode']:<8} {r['reads']:>8} {r['writes']:>8} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+              f"{r['p99_ms']:>8} {r['max_ms']:>8}")
+
+if __name__ == "__main__":
+    main()
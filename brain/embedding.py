@@ -0,0 +1,139 @@
+# brain/embedding.py
+# Embedding providers shared by storage (GUI) and integration.py (Flask), so both paths search one vector space.
+# Pick one with SECOND_BRAIN_EMBEDDER=ollama|local; the local engine is tuned with
+# SECOND_BRAIN_EMBED_THREADS, SECOND_BRAIN_EMBED_BACKEND=torch|onnx and SECOND_BRAIN_EMBED_INT8=1.
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import llm
+
+_providers = {}
+_current = None
+_current_lock = threading.Lock()
+
+def register(name):
+    def deco(cls):
+        _providers[name] = cls
+        return cls
+    return deco
+
+@register("ollama")
+class OllamaEmbedder:
+    def __init__(self, model: str = None):
+        self.model = model or llm.EMBED_MODEL
+        self.key = f"ollama:{self.model}"
+
+    def embed_many(self, texts):
+        return llm.embed_many(texts, self.model)
+
+@register("local")
+class LocalEmbedder:
+    # In-process sentence-transformers model. Concurrent callers are coalesced into one encode() call:
+    # the worker takes whatever arrives within max_wait seconds, up to max_batch texts.
+    def __init__(self, model: str = None, threads: int = None, backend: str = "torch", int8: bool = False,
+                 max_batch: int = 64, max_wait: float = 0.005):
+        self.model = model or "all-MiniLM-L6-v2"
+        self.key = f"local:{self.model}" + (":int8" if int8 else "")
+        self.threads = threads
+        self.backend = backend
+        self.int8 = int8
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._st = None
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self.threads and self.backend == "onnx":
+            os.environ.setdefault("OMP_NUM_THREADS", str(self.threads))
+        from sentence_transformers import SentenceTransformer
+        kwargs = {}
+        if self.backend == "onnx":
+            kwargs["backend"] = "onnx"
+            if self.int8:
+                kwargs["model_kwargs"] = {"file_name": "onnx/model_qint8_avx2.onnx"}
+        st = SentenceTransformer(self.model, device="cpu", **kwargs)
+        if self.backend == "torch":
+            import torch
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            if self.int8:
+                st = torch.quantization.quantize_dynamic(st, {torch.nn.Linear}, dtype=torch.qint8)
+        return st
+
+    def embed_many(self, texts):
+        if not texts:
+            return []
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, daemon=True, name="embedder")
+                self._worker.start()
+        fut = Future()
+        self._queue.put((list(texts), fut))
+        return fut.result()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            size = len(items[0][0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                items.append(item)
+                size += len(item[0])
+            try:
+                if self._st is None:
+                    self._st = self._load()
+                vecs = self._st.encode([t for texts, _ in items for t in texts], batch_size=self.max_batch,
+                                       normalize_embeddings=True, convert_to_numpy=True)
+            except Exception as e:
+                for _, fut in items:
+                    fut.set_exception(e)
+                continue
+            vecs = vecs.astype("float32", copy=False)
+            pos = 0
+            for texts, fut in items:
+                fut.set_result(list(vecs[pos:pos + len(texts)]))
+                pos += len(texts)
+
+def _from_env():
+    name = os.environ.get("SECOND_BRAIN_EMBEDDER", "ollama")
+    if name == "local":
+        return LocalEmbedder(
+            model=os.environ.get("SECOND_BRAIN_EMBED_MODEL"),
+            threads=int(os.environ.get("SECOND_BRAIN_EMBED_THREADS", "0")) or None,
+            backend=os.environ.get("SECOND_BRAIN_EMBED_BACKEND", "torch"),
+            int8=os.environ.get("SECOND_BRAIN_EMBED_INT8") == "1",
+        )
+    return _providers[name]()
+
+def get_embedder():
+    global _current
+    with _current_lock:
+        if _current is None:
+            _current = _from_env()
+        return _current
+
+def create_embedder(name: str, **options):
+    return _providers[name](**options)
+
+def set_embedder(name: str, **options):
+    return use_embedder(create_embedder(name, **options))
+
+def use_embedder(embedder):
+    global _current
+    with _current_lock:
+        _current = embedder
+    return embedder
+
+def embed_many(texts):
+    return get_embedder().embed_many(texts)
+
+def embed(text: str):
+    return embed_many([text])[0]
@@ -1,17 +1,22 @@
 from datetime import datetime, date
+import time
 import re
 import json
 import shutil
+import sqlite3
+import threading
 from PySide6.QtWidgets import (
     QDialog, QWidget, QTextEdit, QTextBrowser, QVBoxLayout, QLineEdit, QPushButton,
-    QHBoxLayout, QSystemTrayIcon, QTableWidget, QTableWidgetItem, QFileDialog,
+    QHBoxLayout, QSystemTrayIcon, QTableView, QHeaderView, QStyledItemDelegate, QStyle, QFileDialog,
     QDateEdit, QComboBox, QGridLayout, QGroupBox, QLabel, QProgressBar, QFormLayout, QGraphicsOpacityEffect
 )
-from PySide6.QtCore import Qt, QSize, QThread, Signal, QDate, QPropertyAnimation
+from PySide6.QtCore import (
+    Qt, QSize, QThread, Signal, QDate, QPropertyAnimation, QAbstractTableModel, QModelIndex, QEvent, QRect, QTimer, QCoreApplication
+)
 from PySide6.QtGui import QKeySequence, QIcon, QMovie, QFont
 
-from .storage import add, topk, delete, get_note, update_note, export_notes, DB, filter_notes, get_recent_notes, get_favorite_notes, toggle_favorite
-from .llm import chat
+from .storage import add, topk, delete, get_note, update_note, export_notes, DB, filter_notes, get_recent_notes, get_favorite_notes, toggle_favorite, encode_cursor, get_conn, pack_context, cached_answer, store_answer, embed_queue_status
+from llm import chat_stream  # the module storage and embedding use, so one session, semaphore and breaker
 
 STYLE_SHEET = """
 QWidget {
@@ -35,12 +40,12 @@ QLineEdit, QTextEdit, QDateEdit, QComboBox {
     border-radius: 8px;
     background-color: white;
 }
-QTableWidget {
+QTableView {
     selection-background-color: #e8f5e9;
     border: 1px solid #e0e0e0;
     alternate-background-color: #f5f5f5;
 }
-QTableWidget::item:hover {
+QTableView::item:hover {
     background-color: #f0f0f0;
 }
 QGroupBox {
@@ -99,6 +104,13 @@ class AddNote(QWidget):
         linking_label = QLabel("Use [[note_id]] to link notes (e.g., [[5]])")
         linking_label.setStyleSheet("font-size: 12px; color: #757575;")
 
+        # Notes are searchable by meaning once the background embedder has caught up
+        self.queue_label = QLabel()
+        self.queue_label.setStyleSheet("font-size: 12px; color: #757575;")
+        self.queue_timer = QTimer(self)
+        self.queue_timer.setInterval(1000)
+        self.queue_timer.timeout.connect(self._show_queue)
+
         save_btn = QPushButton("Save (⌘S)")
         close_btn = QPushButton("Close")
         save_btn.setStyleSheet("background-color: #4CAF50; color: white;")
@@ -108,6 +120,7 @@ class AddNote(QWidget):
 
         btn_row = QHBoxLayout()
         btn_row.addWidget(insert_link_btn)
+        btn_row.addWidget(self.queue_label)
         btn_row.addStretch()
         btn_row.addWidget(save_btn)
         btn_row.addWidget(close_btn)
@@ -133,10 +146,28 @@ class AddNote(QWidget):
             self.text.clear()
             self.tags_input.clear()
             self.text.setFocus()
+            self._show_queue()
+
+    def _show_queue(self):
+        status = embed_queue_status()
+        if not status["pending"]:
+            self.queue_label.clear()
+        elif status["retrying"]:
+            self.queue_label.setText(f"Indexing {status['pending']} chunks, retrying…")
+            self.queue_label.setToolTip(status["last_error"] or "")
+        else:
+            self.queue_label.setText(f"Indexing {status['pending']} chunks…")
+            self.queue_label.setToolTip("")
 
     def show(self):
         super().show()
         self.text.setFocus()
+        self._show_queue()
+        self.queue_timer.start()
+
+    def hideEvent(self, event):
+        self.queue_timer.stop()
+        super().hideEvent(event)
 
 class EditNote(QWidget):
     def __init__(self, tray, nid):
@@ -203,6 +234,8 @@ class EditNote(QWidget):
 
 class Ask(QWidget):
     class Worker(QThread):
+        context = Signal(list)
+        tokens = Signal(str)
         result = Signal(str, list)
 
         def __init__(self, q, tags, date_start, date_end):
@@ -213,19 +246,38 @@ class Ask(QWidget):
             self.date_end = date_end
 
         def run(self):
-            ctx = topk(self.q, k=6, tags=self.tags, date_start=self.date_start, date_end=self.date_end)
-            if not ctx:
-                self.result.emit("I don’t have that info in my notes.", [])
-                return
-            ctx_block = "\n".join(f"[[{nid}]] {b}" for nid, b in ctx)
-            prompt = (
-                "Here are my notes:\n" + ctx_block + "\n\n"
-                "Using ONLY these notes, answer the question below. "
-                "If the answer isn’t in the notes, say 'I don’t know.' "
-                "Cite notes with [[nid]].\n\n"
-                f"Question: {self.q}\nAnswer:"
-            )
-            self.result.emit(chat(prompt), ctx)
+            ctx, answer = [], ""
+            try:
+                ctx = topk(self.q, k=6, tags=self.tags, date_start=self.date_start, date_end=self.date_end)
+                self.context.emit(ctx)
+                if not ctx:
+                    self.result.emit("I don’t have that info in my notes.", [])
+                    return
+                cached = cached_answer(self.q, ctx)
+                if cached is not None:
+                    self.result.emit(cached, ctx)
+                    return
+                ctx_block = "\n".join(f"[[{nid}]] {b}" for nid, b in pack_context(self.q, ctx))
+                prompt = (
+                    "Here are my notes:\n" + ctx_block + "\n\n"
+                    "Using ONLY these notes, answer the question below. "
+                    "If the answer isn’t in the notes, say 'I don’t know.' "
+                    "Cite notes with [[nid]].\n\n"
+                    f"Question: {self.q}\nAnswer:"
+                )
+                # Batch tokens so the view repaints at most every 50 ms
+                answer, pending, last = "", "", time.monotonic()
+                for piece in chat_stream(prompt):
+                    answer += piece
+                    pending += piece
+                    if time.monotonic() - last >= 0.05:
+                        self.tokens.emit(pending)
+                        pending, last = "", time.monotonic()
+                store_answer(self.q, ctx, answer)
+                self.result.emit(answer, ctx)
+            except Exception as e:
+                # Without a result the spinner keeps turning and the query box stays disabled
+                self.result.emit(f"{answer}\n\nError: {e}".lstrip(), ctx)
 
     def __init__(self):
         super().__init__()
@@ -283,10 +335,23 @@ class Ask(QWidget):
         self.answer.clear()
         self.spinner.show()
         self.spinner_movie.start()
+        self._partial = ""
         self.worker = self.Worker(q, tags, date_start, date_end)
+        self.worker.context.connect(self._set_context)
+        self.worker.tokens.connect(self._append)
         self.worker.result.connect(self._show)
         self.worker.start()
 
+    def _set_context(self, ctx):
+        self._ctx = {nid: b for nid, b in ctx}
+
+    def _append(self, text):
+        self.spinner_movie.stop()
+        self.spinner.hide()
+        self._partial += text
+        html = re.sub(r"\[\[(\d+)\]\]", lambda m: f'<a href="{m.group(1)}">[[{m.group(1)}]]</a>', self._partial)
+        self.answer.setHtml(html)
+
     def _show(self, ans, ctx):
         self.spinner_movie.stop()
         self.spinner.hide()
@@ -306,6 +371,223 @@ class Ask(QWidget):
         super().show()
         self.query.setFocus()
 
+NOTE_PAGE = 200
+ACTION_COLUMNS = {3: "delete", 4: "edit", 5: "favorite"}
+
+FILTER_DEBOUNCE_MS = 250
+
+class NoteQuery(QThread):
+    # Runs listing queries on its own thread, and so on its own SQLite connection. Only the newest
+    # request matters: submitting one interrupts a statement still running for an older one.
+    page = Signal(int, list, bool)  # request, rows, more rows available
+    failed = Signal(int, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._cond = threading.Condition()
+        self._pending = None
+        self._latest = 0
+        self._running = None
+        self._conn = None
+        self._stopping = False
+
+    def submit(self, query, cursor=None) -> int:
+        with self._cond:
+            self._latest += 1
+            self._pending = (self._latest, query, cursor)
+            if self._running is not None:
+                self._conn.interrupt()
+            self._cond.notify()
+            return self._latest
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            if self._running is not None:
+                self._conn.interrupt()
+            self._cond.notify()
+        self.wait()
+
+    def run(self):
+        self._conn = get_conn()
+        while True:
+            with self._cond:
+                while self._pending is None and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                request, query, cursor = self._pending
+                self._pending = None
+                self._running = request
+            try:
+                rows = query(NOTE_PAGE, cursor)
+                error = None
+            except sqlite3.Error as e:
+                rows, error = [], str(e)
+            with self._cond:
+                self._running = None
+                if request != self._latest:
+                    continue  # superseded, possibly interrupted mid-statement
+            if error:
+                self.failed.emit(request, error)
+            else:
+                self.page.emit(request, rows, len(rows) == NOTE_PAGE)
+
+class NotesModel(QAbstractTableModel):
+    # Rows are pulled a page at a time as the view scrolls (canFetchMore/fetchMore) and only the
+    # fields the table shows are kept, so opening the window costs one page whatever the vault size.
+    # Pages are loaded by NoteQuery off the GUI thread and appended as they arrive.
+    loaded = Signal(bool)  # emitted after the first page of a query, with whether it had rows
+    failed = Signal(str)  # emitted when a page could not be loaded, with the error
+    HEADERS = ["ID", "Tags", "Snippet", "", "", "Fav"]
+    TIPS = ["Note ID", "Tags", "Snippet", "Delete", "Edit", "Favorite"]
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._rows = []
+        self._query = None
+        self._more = False
+        self._request = None
+        self._first = False
+        self._loader = NoteQuery(self)
+        self._loader.page.connect(self._page)
+        self._loader.failed.connect(self._failed)
+        self._loader.start()
+        if QCoreApplication.instance() is not None:
+            QCoreApplication.instance().aboutToQuit.connect(self._loader.stop)
+        self._icons = {
+            "delete": QIcon.fromTheme("edit-delete"),
+            "edit": QIcon.fromTheme("document-edit"),
+            "favorite": QIcon.fromTheme("emblem-favorite"),
+            "not-favorite": QIcon.fromTheme("emblem-unreadable"),
+        }
+
+    def set_query(self, query):
+        # query(limit, cursor) returns note rows newest first; cursor is None for the first page
+        self.beginResetModel()
+        self._rows = []
+        self._query = query
+        self._more = False
+        self._first = query is not None
+        self._request = self._loader.submit(query) if query is not None else None
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self._more and self._request is None
+
+    def fetchMore(self, parent=QModelIndex()):
+        if not self.canFetchMore(parent):
+            return
+        self._request = self._loader.submit(self._query, encode_cursor(self._rows[-1]))
+
+    def _page(self, request, rows, more):
+        if request != self._request:
+            return
+        self._request = None
+        self._more = more
+        self.append_rows(rows)
+        if self._first:
+            self._first = False
+            self.loaded.emit(bool(rows))
+
+    def _failed(self, request, error):
+        if request == self._request:
+            self._request = None
+            self._first = False
+            self.failed.emit(error)
+
+    def append_rows(self, rows):
+        if not rows:
+            return
+        first = len(self._rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+        for nid, parent_id, ts, body, tags, is_favorite in rows:
+            self._rows.append((nid, parent_id, ts, body.replace("\n", " ")[:80], tags or "", bool(is_favorite)))
+        self.endInsertRows()
+
+    def note_id(self, row):
+        return self._rows[row][0]
+
+    def find(self, nid):
+        for row, note in enumerate(self._rows):
+            if note[0] == nid:
+                return row
+        return -1
+
+    def set_favorite(self, nid, is_favorite):
+        row = self.find(nid)
+        if row >= 0:
+            self._rows[row] = self._rows[row][:5] + (bool(is_favorite),)
+            self.dataChanged.emit(self.index(row, 5), self.index(row, 5))
+
+    def remove(self, nid):
+        row = self.find(nid)
+        if row >= 0:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self._rows[row]
+            self.endRemoveRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        nid, _, ts, snippet, tags, is_favorite = self._rows[index.row()]
+        col = index.column()
+        if role == Qt.DisplayRole:
+            if col == 0:
+                return str(nid)
+            if col == 1:
+                return tags
+            if col == 2:
+                return f"{datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M')} — {snippet}"
+        elif role == Qt.DecorationRole and col in ACTION_COLUMNS:
+            action = ACTION_COLUMNS[col]
+            if action == "favorite" and not is_favorite:
+                action = "not-favorite"
+            return self._icons[action]
+        elif role == Qt.ToolTipRole and col in ACTION_COLUMNS:
+            return self.TIPS[col]
+        elif role == Qt.UserRole:
+            return nid
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation != Qt.Horizontal:
+            return None
+        if role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        if role == Qt.ToolTipRole:
+            return self.TIPS[section]
+        return None
+
+class ActionDelegate(QStyledItemDelegate):
+    # Paints a row's action icon in place of a per-row button and reports clicks on it.
+    clicked = Signal(str, int)
+
+    def paint(self, painter, option, index):
+        if option.state & QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        icon = index.data(Qt.DecorationRole)
+        if icon is not None:
+            size = min(option.rect.height() - 6, 20)
+            rect = QRect(0, 0, size, size)
+            rect.moveCenter(option.rect.center())
+            icon.paint(painter, rect)
+
+    def sizeHint(self, option, index):
+        return QSize(28, 24)
+
+    def editorEvent(self, event, model, option, index):
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            self.clicked.emit(ACTION_COLUMNS[index.column()], index.data(Qt.UserRole))
+            return True
+        return False
+
 class BrowseNotes(QWidget):
     def __init__(self, tray):
         super().__init__()
@@ -342,51 +624,76 @@ class BrowseNotes(QWidget):
         top_layout.addWidget(filter_group)
         top_layout.addWidget(export_btn)
 
-        self.table = QTableWidget(columnCount=6)
-        self.table.setHorizontalHeaderLabels(["ID", "Tags", "Snippet", "", "", "Fav"])
-        self.table.horizontalHeader().setStretchLastSection(True)
-        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.model = NotesModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setEditTriggers(QTableView.NoEditTriggers)
         self.table.verticalHeader().hide()
+        # Fixed row height and column widths keep layout independent of how many rows are loaded
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(28)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(QHeaderView.Interactive)
+        header.setSectionResizeMode(2, QHeaderView.Stretch)
+        for col, width in ((0, 50), (1, 120), (3, 32), (4, 32), (5, 40)):
+            header.resizeSection(col, width)
         self.table.setAlternatingRowColors(True)
-        self.table.setSelectionBehavior(QTableWidget.SelectRows)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.setSelectionMode(QTableView.SingleSelection)
         self.table.doubleClicked.connect(self._open_note)
-        # Tooltips for clarity
-        for i, tip in enumerate(["Note ID", "Tags", "Snippet", "Delete", "Edit", "Favorite"]):
-            self.table.horizontalHeaderItem(i).setToolTip(tip)
+        self.actions = ActionDelegate(self.table)
+        self.actions.clicked.connect(self._action)
+        for col in ACTION_COLUMNS:
+            self.table.setItemDelegateForColumn(col, self.actions)
 
         layout = QVBoxLayout(self)
         layout.addLayout(top_layout)
         layout.addWidget(self.table)
 
-        self.text_filter.textChanged.connect(self.refresh)
-        self.tag_filter.textChanged.connect(self.refresh)
-        self.date_start.dateChanged.connect(self.refresh)
-        self.date_end.dateChanged.connect(self.refresh)
-        self._notes = []
+        # Typing restarts the timer, so the query runs once the filters stop changing
+        self._debounce = QTimer(self, singleShot=True, interval=FILTER_DEBOUNCE_MS)
+        self._debounce.timeout.connect(self.refresh)
+        self.text_filter.textChanged.connect(self._debounce.start)
+        self.tag_filter.textChanged.connect(self._debounce.start)
+        self.date_start.dateChanged.connect(self._debounce.start)
+        self.date_end.dateChanged.connect(self._debounce.start)
+        self.model.loaded.connect(self._loaded)
+        self.model.failed.connect(self._load_failed)
         self.refresh()
 
     def _open_note(self):
-        row = self.table.currentRow()
+        row = self.table.currentIndex().row()
         if row >= 0:
-            nid = int(self.table.item(row, 0).text())
+            nid = self.model.note_id(row)
             viewer = NoteViewer(nid, parent=self)
             viewer.show()
 
+    def _action(self, action, nid):
+        if action == "delete":
+            self._delete(nid)
+        elif action == "edit":
+            self._edit(nid)
+        elif action == "favorite":
+            self._toggle_favorite(nid)
+
     def _table_keys(self, event):
         key = event.key()
-        row = self.table.currentRow()
+        row = self.table.currentIndex().row()
         if key in (Qt.Key_Delete, Qt.Key_Backspace) and row >= 0:
-            self._delete(int(self.table.item(row, 0).text()))
+            self._delete(self.model.note_id(row))
         elif key in (Qt.Key_Enter, Qt.Key_Return) and row >= 0:
             self._open_note()
         elif key == Qt.Key_F and row >= 0:
-            self._toggle_favorite(int(self.table.item(row, 0).text()))
+            self._toggle_favorite(self.model.note_id(row))
         else:
-            super(QTableWidget, self.table).keyPressEvent(event)
+            super(QTableView, self.table).keyPressEvent(event)
 
     def _toggle_favorite(self, nid):
         is_favorite = toggle_favorite(nid)
-        self.refresh()
+        if self.view_mode.currentText().lower() == "favorites" and not is_favorite:
+            self.model.remove(nid)
+        else:
+            self.model.set_favorite(nid, is_favorite)
         status = "added to" if is_favorite else "removed from"
         self.tray.showMessage("Second Brain", f"Note {nid} {status} favorites", QSystemTrayIcon.Information, 2000)
 
@@ -400,46 +707,28 @@ class BrowseNotes(QWidget):
                     if self.date_end.date().isValid() else None)
 
         if view_mode == "recent":
-            self._notes = get_recent_notes(limit=10)
+            query = lambda limit, cursor: get_recent_notes(limit=10)
         elif view_mode == "favorites":
-            self._notes = get_favorite_notes()
+            query = lambda limit, cursor: get_favorite_notes(limit=limit, cursor=cursor)
         else:
-            self._notes = filter_notes(txt, tag_filter, date_start, date_end)
-
-        self.table.setRowCount(len(self._notes))
-        for row, (nid, _, ts, body, tags, is_favorite) in enumerate(self._notes):
-            ts_str = datetime.fromtimestamp(ts).strftime("%Y-%m-d %H:%M")
-            snippet = body.replace("\n", " ")[:80]
-            snippet_item = QTableWidgetItem(f"{ts_str} — {snippet}")
-            snippet_item.setData(Qt.UserRole, body)
-            self.table.setItem(row, 0, QTableWidgetItem(str(nid)))
-            self.table.setItem(row, 1, QTableWidgetItem(tags or ""))
-            self.table.setItem(row, 2, snippet_item)
-            del_btn = QPushButton()
-            del_btn.setIcon(QIcon.fromTheme("edit-delete"))
-            del_btn.setFixedWidth(28)
-            del_btn.clicked.connect(lambda _, id=nid: self._delete(id))
-            self.table.setCellWidget(row, 3, del_btn)
-            edit_btn = QPushButton()
-            edit_btn.setIcon(QIcon.fromTheme("document-edit"))
-            edit_btn.setFixedWidth(28)
-            edit_btn.clicked.connect(lambda _, id=nid: self._edit(id))
-            self.table.setCellWidget(row, 4, edit_btn)
-            fav_btn = QPushButton()
-            fav_btn.setIcon(QIcon.fromTheme("emblem-favorite" if is_favorite else "emblem-unreadable"))
-            fav_btn.setFixedWidth(28)
-            fav_btn.clicked.connect(lambda _, id=nid: self._toggle_favorite(id))
-            self.table.setCellWidget(row, 5, fav_btn)
-        self.table.resizeColumnsToContents()
-        if self._notes:
+            query = lambda limit, cursor: filter_notes(txt, tag_filter, date_start, date_end, limit=limit, cursor=cursor)
+
+        self._debounce.stop()
+        self.model.set_query(query)
+
+    def _loaded(self, has_rows):
+        if has_rows:
             self.table.selectRow(0)
-        elif any([txt, tag_filter, date_start, date_end, view_mode]):
+        else:
             self.tray.showMessage("Second Brain", "No notes match the filters", QSystemTrayIcon.Information, 2000)
 
+    def _load_failed(self, error):
+        self.tray.showMessage("Second Brain", f"Could not load notes: {error}", QSystemTrayIcon.Warning, 4000)
+
     def _delete(self, nid):
         delete(nid)
         self.tray.showMessage("Second Brain", f"Note {nid} deleted", QSystemTrayIcon.Information, 2000)
-        self.refresh()
+        self.model.remove(nid)
 
     def _edit(self, nid):
         editor = EditNote(self.tray, nid)
@@ -0,0 +1,88 @@
+# brain/importer.py
+# Usage: python brain/importer.py notes.json|notes.ndjson|notes_dir/ [--restart]
+import sys
+import json
+import pathlib
+import argparse
+from storage import import_notes, writer
+
+def read_json(path):
+    # Streams the objects of a top-level JSON array (the export_notes format) without loading the file.
+    decoder = json.JSONDecoder()
+    buf, pos, started = "", 0, False
+    with open(path, encoding="utf-8") as f:
+        while True:
+            chunk = f.read(1 << 16)
+            buf = buf[pos:] + chunk
+            pos = 0
+            while True:
+                while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","):
+                    pos += 1
+                if not started and pos < len(buf):
+                    if buf[pos] != "[":
+                        raise ValueError(f"{path} is not a JSON array")
+                    started = True
+                    pos += 1
+                    continue
+                if pos >= len(buf) or buf[pos] == "]":
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    break  # object continues in the next chunk
+                yield obj
+                pos = end
+            if not chunk or (pos < len(buf) and buf[pos] == "]"):
+                return
+
+def read_ndjson(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def read_markdown_dir(path):
+    for md in sorted(pathlib.Path(path).rglob("*.md")):
+        text = md.read_text(encoding="utf-8")
+        tags = ""
+        if text.startswith("---\n") and "\n---" in text[4:]:
+            front, text = text[4:].split("\n---", 1)
+            for line in front.splitlines():
+                if line.lower().startswith("tags:"):
+                    tags = ",".join(t.strip(" []'\"") for t in line[5:].split(",") if t.strip(" []'\""))
+        yield {"body": text.strip(), "tags": tags, "timestamp": md.stat().st_mtime}
+
+def read_source(path):
+    p = pathlib.Path(path)
+    if p.is_dir():
+        return read_markdown_dir(p)
+    if p.suffix in (".ndjson", ".jsonl"):
+        return read_ndjson(p)
+    return read_json(p)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import notes into Second Brain")
+    parser.add_argument("path", help="export_notes JSON file, NDJSON file or a folder of Markdown files")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint from an earlier run")
+    parser.add_argument("--batch-size", type=int, default=256, help="chunks per embedding/insert batch")
+    args = parser.parse_args(argv)
+
+    source = str(pathlib.Path(args.path).resolve())
+    if args.restart:
+        with writer() as conn:
+            conn.execute("DELETE FROM imports WHERE source=?", (source,))
+            conn.execute("DELETE FROM import_ids WHERE source=?", (source,))
+
+    def progress(r):
+        print(f"\r{r['records']} notes, {r['chunks']} chunks, {r['records_per_s']} notes/s", end="", file=sys.stderr)
+
+    report = import_notes(read_source(args.path), source=source, batch_size=args.batch_size, progress=progress)
+    print(file=sys.stderr)
+    print(f"Imported {report['records']} notes ({report['chunks']} chunks) in {report['seconds']}s: "
+          f"{report['records_per_s']} notes/s, {report['chunks_per_s']} chunks/s"
+          + (f", resumed after {report['skipped']}" if report["skipped"] else ""))
+
+if __name__ == "__main__":
+    main()
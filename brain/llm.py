@@ -1,29 +1,184 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 
-OLLAMA = "http://localhost:11434"
+# Override with environment variables, e.g. SECOND_BRAIN_CHAT_MODEL=llama3.1:8b
+OLLAMA = os.environ.get("SECOND_BRAIN_OLLAMA", "http://localhost:11434").rstrip("/")
+EMBED_MODEL = os.environ.get("SECOND_BRAIN_EMBED_MODEL", "nomic-embed-text")
+CHAT_MODEL = os.environ.get("SECOND_BRAIN_CHAT_MODEL", "llama3:8b")
+MAX_IN_FLIGHT = int(os.environ.get("SECOND_BRAIN_MAX_IN_FLIGHT", "4"))
+
+# (connect, read) seconds per endpoint; chat reads are slow because generation happens before the reply
+TIMEOUTS = {
+    "/api/embed": (3, 60),
+    "/api/chat": (3, 300),
+}
+DEFAULT_TIMEOUT = (3, 60)
+RETRIES = 3
+BACKOFF = 0.5  # seconds, doubled per attempt
+RETRY_STATUS = {429, 500, 502, 503, 504}
+BREAKER_THRESHOLD = 5  # consecutive failed calls before Ollama is considered down
+BREAKER_COOLDOWN = 30  # seconds to fail fast before trying again
+
+class OllamaUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT))
+_session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_IN_FLIGHT))
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+_executor = ThreadPoolExecutor(max_workers=MAX_IN_FLIGHT, thread_name_prefix="ollama")
+_breaker_lock = threading.Lock()
+_failures = 0
+_open_until = 0.0
+
+def _breaker_check():
+    with _breaker_lock:
+        if time.monotonic() < _open_until:
+            raise OllamaUnavailable(f"Ollama at {OLLAMA} is unavailable; retrying in {_open_until - time.monotonic():.0f}s")
+
+def _breaker_record(ok: bool):
+    global _failures, _open_until
+    with _breaker_lock:
+        if ok:
+            _failures = 0
+            return
+        _failures += 1
+        if _failures >= BREAKER_THRESHOLD:
+            _open_until = time.monotonic() + BREAKER_COOLDOWN
+
+def _send(path, payload, stream=False):
+    # POST with retries and exponential backoff on connection errors, timeouts and 429/5xx replies.
+    _breaker_check()
+    for attempt in range(RETRIES + 1):
+        try:
+            r = _session.post(f"{OLLAMA}{path}", json=payload, timeout=TIMEOUTS.get(path, DEFAULT_TIMEOUT), stream=stream)
+            if r.status_code in RETRY_STATUS and attempt < RETRIES:
+                r.close()
+            else:
+                r.raise_for_status()
+                _breaker_record(True)
+                return r
+        except requests.exceptions.HTTPError as e:
+            _breaker_record(e.response.status_code < 500)
+            raise
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if attempt == RETRIES:
+                _breaker_record(False)
+                raise
+        time.sleep(BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
 
 def _post_json(path, payload):
     try:
-        r = requests.post(f"{OLLAMA}{path}", json=payload, timeout=60)
-        r.raise_for_status()
-        return r.json()
+        with _in_flight:
+            with _send(path, payload) as r:
+                return r.json()
     except requests.exceptions.HTTPError as e:
         if e.response.status_code == 404:
-            print("Error: Could not find the embedding model on Ollama. Ensure Ollama is running and the 'nomic-embed-text' model is installed (run 'ollama pull nomic-embed-text').")
+            print(f"Error: Could not find the model on Ollama. Ensure Ollama is running and the '{payload.get('model')}' model is installed (run 'ollama pull {payload.get('model')}').")
         raise
 
+EMBED_BATCH = 64
+
 def embed(text: str) -> list[float]:
-    data = _post_json(
-        "/api/embeddings",
-        {"model": "nomic-embed-text", "prompt": text}
-    )
-    return data.get("embedding") or data.get("data") or []
+    return embed_many([text])[0]
+
+def embed_many(texts: list[str], model: str = None) -> list[list[float]]:
+    # /api/embed takes a list input, so a long note costs one round-trip per EMBED_BATCH chunks.
+    out = []
+    for i in range(0, len(texts), EMBED_BATCH):
+        batch = texts[i:i + EMBED_BATCH]
+        data = _post_json(
+            "/api/embed",
+            {"model": model or EMBED_MODEL, "input": batch}
+        )
+        vecs = data.get("embeddings") or []
+        out.extend(vecs + [[]] * (len(batch) - len(vecs)))
+    return out
 
 def chat(prompt: str) -> str:
     data = _post_json(
         "/api/chat",
-        {"model": "llama3:8b",
+        {"model": CHAT_MODEL,
          "messages": [{"role": "user", "content": prompt}],
          "stream": False}
     )
-    return data.get("message", {}).get("content", "")
\ No newline at end of file
+    return data.get("message", {}).get("content", "")
+
+def chat_stream(prompt: str):
+    # Yields the answer piece by piece as the model generates it.
+    with _in_flight:
+        with _send(
+            "/api/chat",
+            {"model": CHAT_MODEL,
+             "messages": [{"role": "user", "content": prompt}],
+             "stream": True},
+            stream=True
+        ) as r:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise RuntimeError(data["error"])
+                piece = data.get("message", {}).get("content", "")
+                if piece:
+                    yield piece
+                if data.get("done"):
+                    break
+
+# asyncio counterparts. Requests still go through the pooled client above, on a thread pool sized to
+# MAX_IN_FLIGHT, so many coroutines can wait on Ollama from one event loop without extra dependencies.
+
+async def aembed(text: str) -> list[float]:
+    return (await aembed_many([text]))[0]
+
+async def aembed_many(texts: list[str]) -> list[list[float]]:
+    # The configured provider, as in the synchronous path; embedding imports this module
+    import embedding
+    embed = embedding.get_embedder().embed_many
+    loop = asyncio.get_running_loop()
+    batches = await asyncio.gather(*(
+        loop.run_in_executor(_executor, embed, texts[i:i + EMBED_BATCH])
+        for i in range(0, len(texts), EMBED_BATCH)
+    ))
+    return [vec for batch in batches for vec in batch]
+
+async def achat(prompt: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, chat, prompt)
+
+async def achat_stream(prompt: str):
+    loop = asyncio.get_running_loop()
+    pieces = asyncio.Queue()
+    stop = threading.Event()
+    end = object()
+
+    def pump():
+        try:
+            for piece in chat_stream(prompt):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(pieces.put_nowait, piece)
+        except Exception as e:
+            loop.call_soon_threadsafe(pieces.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(pieces.put_nowait, end)
+
+    worker = loop.run_in_executor(_executor, pump)
+    try:
+        while True:
+            item = await pieces.get()
+            if item is end:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        await asyncio.shield(worker)
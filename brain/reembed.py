@@ -0,0 +1,37 @@
+# brain/reembed.py
+# Usage: python brain/reembed.py [--embedder ollama|local] [--model NAME] [--restart]
+# Re-embeds every note with the given provider (default: SECOND_BRAIN_EMBEDDER) while search keeps using the
+# current vectors, then switches over. Interrupted runs resume from their checkpoint.
+import sys
+import argparse
+from embedding import create_embedder, get_embedder
+from storage import reembed, reembed_status, writer
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-embed Second Brain notes with another embedding model")
+    parser.add_argument("--embedder", help="embedding provider, ollama or local")
+    parser.add_argument("--model", help="model name for the provider")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint from an earlier run")
+    parser.add_argument("--batch-size", type=int, default=64, help="chunks per embedding request and checkpoint")
+    args = parser.parse_args(argv)
+
+    embedder = create_embedder(args.embedder, model=args.model) if args.embedder else get_embedder()
+    if args.restart:
+        with writer() as conn:
+            conn.execute("DELETE FROM settings WHERE key='reembed'")
+    status = reembed_status()
+    print(f"{status['chunks']} chunks embedded with {status['model']}, re-embedding with {embedder.key}"
+          + (f", resuming after {status['job']['done']}" if status["job"] and status["job"]["model"] == embedder.key
+             else ""), file=sys.stderr)
+
+    def progress(r):
+        print(f"\r{r['skipped'] + r['chunks']}/{status['chunks']} chunks, {r['chunks_per_s']} chunks/s", end="",
+              file=sys.stderr)
+
+    report = reembed(embedder, batch_size=args.batch_size, progress=progress)
+    print(file=sys.stderr)
+    print(f"Re-embedded {report['chunks']} chunks in {report['seconds']}s: {report['chunks_per_s']} chunks/s; "
+          f"search now uses {embedder.key}")
+
+if __name__ == "__main__":
+    main()
@@ -5,24 +5,137 @@ import pathlib
 import numpy as np
 import hnswlib
 import re
+import os
+import base64
+import hashlib
+import json
+import atexit
+import queue
+import asyncio
 import threading
-from functools import lru_cache
-from llm import embed  # Absolute import at the top
+import itertools
+import logging
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from embedding import embed_many, get_embedder, use_embedder  # Absolute import at the top
+from llm import CHAT_MODEL
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
 
 HOME = pathlib.Path.home()
 APP = HOME / ".second-brain"
 APP.mkdir(mode=0o700, exist_ok=True)
 DB = APP / "second_brain.db"
+INDEX = APP / "second_brain.hnsw"
+INDEX_META = APP / "second_brain.hnsw.json"
+VECS = APP / "second_brain.vecs"  # the first app's exact-index files; a second one gets second_brain.vecs.1*
+INDEX_FLUSH_EVERY = 256
+INDEX_CAPACITY = 1024  # initial max_elements; doubled whenever the index fills
+COMPACT_RATIO = 0.2  # rebuild the index in the background once this share of its labels are deleted
+COMPACT_MIN_DELETED = 256
+EMBED_CACHE_MAX = 50_000  # cached vectors kept across all models
+TOPK_CACHE_SIZE = 256
+TOPK_CACHE_TTL = 300.0  # seconds
+EXACT_SEARCH_MAX = 2048  # filtered searches over at most this many notes skip the ANN index
+# How notes.emb is stored: float32, float16 or int8 (one float32 scale per vector), optionally truncated
+# to the first SECOND_BRAIN_VECTOR_DIMS dimensions (Matryoshka-trained models such as nomic-embed-text
+# keep most of their quality). SECOND_BRAIN_INDEX_DIMS builds the HNSW index over an even shorter prefix;
+# its candidates are then re-scored exactly against the stored vectors.
+VECTOR_CODEC = os.environ.get("SECOND_BRAIN_VECTOR_CODEC", "float32")
+VECTOR_DIMS = int(os.environ.get("SECOND_BRAIN_VECTOR_DIMS", "0"))
+INDEX_DIMS = int(os.environ.get("SECOND_BRAIN_INDEX_DIMS", "0"))
+RESCORE_OVERSAMPLE = 4  # ANN candidates fetched per result when re-scoring
+# auto searches vaults of up to EXACT_MAX vectors exactly over a memory-mapped matrix and builds the
+# HNSW index only past that; exact or hnsw forces one backend.
+SEARCH_BACKEND = os.environ.get("SECOND_BRAIN_SEARCH_BACKEND", "auto")
+EXACT_MAX = int(os.environ.get("SECOND_BRAIN_EXACT_MAX", "20000"))
+EXACT_BLOCK = 8192  # matrix rows scored per product
+CHUNK_TOKENS = 256  # approximate model tokens per chunk
+CHUNK_OVERLAP = 32  # tokens of the previous chunk repeated at the start of the next
+# Saved notes are embedded in the background, CHUNK_EMBED_BATCH queued chunks per request. A failed batch
+# is retried after EMBED_RETRY_BASE seconds, doubled per attempt up to EMBED_RETRY_MAX.
+CHUNK_EMBED_BATCH = 64
+EMBED_RETRY_BASE = 2.0
+EMBED_RETRY_MAX = 300.0
+EMBED_LEASE = 120.0  # seconds a claimed chunk is hidden from the other app's embedder
+# Answer prompts carry at most CONTEXT_TOKENS tokens of notes, and one note at most CONTEXT_NOTE_TOKENS
+CONTEXT_TOKENS = int(os.environ.get("SECOND_BRAIN_CONTEXT_TOKENS", "1500"))
+CONTEXT_NOTE_TOKENS = int(os.environ.get("SECOND_BRAIN_CONTEXT_NOTE_TOKENS", "400"))
+CONTEXT_MIN_TOKENS = 32  # a hit that would get less than this is left out
+# A question is answered from the cache when its embedding is at least this similar to a cached one
+# asked over the same context notes, none of them edited since
+ANSWER_CACHE_THRESHOLD = float(os.environ.get("SECOND_BRAIN_ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_MAX = 1000
+
+# WAL lets readers (this app's and the other one's) run while a write commits; with synchronous=NORMAL a
+# crash of the app loses nothing, only a power cut can lose the last commits. Override the journal with
+# SECOND_BRAIN_JOURNAL_MODE, e.g. DELETE for a database on a network share.
+DB_PRAGMAS = {
+    "journal_mode": os.environ.get("SECOND_BRAIN_JOURNAL_MODE", "WAL"),
+    "synchronous": "NORMAL",
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -32 * 1024,  # KiB per connection
+    "busy_timeout": 5000,  # ms to wait for the other app's write lock
+    "temp_store": "MEMORY",
+}
+READ_POOL_SIZE = 8
+
+def _connect():
+    conn = sqlite3.connect(DB, timeout=DB_PRAGMAS["busy_timeout"] / 1000, check_same_thread=False)
+    for name, value in DB_PRAGMAS.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
 
 local_storage = threading.local()
 
 def get_conn():
+    # A connection owned by the calling thread, e.g. one that needs to interrupt its own queries.
+    # reader() hands it out instead of a pooled one on that thread.
     if not hasattr(local_storage, 'conn'):
-        local_storage.conn = sqlite3.connect(DB)
+        local_storage.conn = _connect()
     return local_storage.conn
 
+# Every write goes through this one connection, one transaction per writer() block
+_writer = _connect()
+_write_lock = threading.Lock()
+
+@contextmanager
+def writer():
+    with _write_lock:
+        with _writer:
+            yield _writer
+
+_read_pool = queue.LifoQueue()
+_read_slots = threading.BoundedSemaphore(READ_POOL_SIZE)
+
+@contextmanager
+def reader():
+    # Borrows one of at most READ_POOL_SIZE read connections, so threads that come and go
+    # (Flask requests, executors) share them instead of opening their own.
+    conn = getattr(local_storage, "conn", None)
+    if conn is not None:
+        yield conn
+        return
+    with _read_slots:
+        try:
+            conn = _read_pool.get_nowait()
+        except queue.Empty:
+            conn = _connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            _read_pool.put(conn)
+
 # Create tables if they don't exist
-get_conn().execute(
+_writer.execute(
     "CREATE TABLE IF NOT EXISTS notes("
     "id INTEGER PRIMARY KEY AUTOINCREMENT,"
     "parent_id INTEGER,"
@@ -33,144 +146,1326 @@ get_conn().execute(
     "is_favorite INTEGER DEFAULT 0)"
 )
 
-get_conn().execute("CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5(body, content='notes', content_rowid='id')")
+_writer.execute("CREATE INDEX IF NOT EXISTS notes_ts ON notes(ts)")
+_writer.execute("CREATE INDEX IF NOT EXISTS notes_fav_ts ON notes(ts) WHERE is_favorite = 1")
+
+# notes_fts ranks topk's word* queries with the help of prefix indexes; notes_trigram serves substring filters
+FTS_TABLES = {
+    "notes_fts": "fts5(body, content='notes', content_rowid='id', prefix='2 3 4')",
+    "notes_trigram": "fts5(body, content='notes', content_rowid='id', tokenize='trigram', detail='none')",
+}
+FTS_MERGE_EVERY = 200  # writes between incremental segment merges
+
+_fts_sql = dict(_writer.execute(
+    "SELECT name, sql FROM sqlite_master WHERE name IN ('notes_fts', 'notes_trigram')").fetchall())
+if any(name not in _fts_sql or schema not in _fts_sql[name] for name, schema in FTS_TABLES.items()):
+    # Older databases lack the prefix/trigram indexes (and their notes_fts may never have been populated): rebuild
+    for trigger in ("notes_ai", "notes_ad", "notes_au"):
+        _writer.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    for name, schema in FTS_TABLES.items():
+        _writer.execute(f"DROP TABLE IF EXISTS {name}")
+        _writer.execute(f"CREATE VIRTUAL TABLE {name} USING {schema}")
+        _writer.execute(f"INSERT INTO {name}({name}) VALUES('rebuild')")
 
 # Triggers for FTS5
-get_conn().execute("""
+_writer.execute("""
 CREATE TRIGGER IF NOT EXISTS notes_ai AFTER INSERT ON notes
 BEGIN
   INSERT INTO notes_fts(rowid, body) VALUES (new.id, new.body);
+  INSERT INTO notes_trigram(rowid, body) VALUES (new.id, new.body);
 END;
 """)
 
-get_conn().execute("""
+_writer.execute("""
 CREATE TRIGGER IF NOT EXISTS notes_ad AFTER DELETE ON notes
 BEGIN
   INSERT INTO notes_fts(notes_fts, rowid, body) VALUES ('delete', old.id, old.body);
+  INSERT INTO notes_trigram(notes_trigram, rowid, body) VALUES ('delete', old.id, old.body);
 END;
 """)
 
-get_conn().execute("""
-CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE ON notes
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS notes_au AFTER UPDATE OF body ON notes
 BEGIN
   INSERT INTO notes_fts(notes_fts, rowid, body) VALUES ('delete', old.id, old.body);
   INSERT INTO notes_fts(rowid, body) VALUES (new.id, new.body);
+  INSERT INTO notes_trigram(notes_trigram, rowid, body) VALUES ('delete', old.id, old.body);
+  INSERT INTO notes_trigram(rowid, body) VALUES (new.id, new.body);
 END;
 """)
 
-# Populate FTS table if empty
-if get_conn().execute("SELECT COUNT(*) FROM notes_fts").fetchone()[0] == 0:
-    get_conn().execute("INSERT INTO notes_fts(rowid, body) SELECT id, body FROM notes")
-
 # Ensure 'tags' and 'is_favorite' columns exist
-cursor = get_conn().execute("PRAGMA table_info(notes)")
+cursor = _writer.execute("PRAGMA table_info(notes)")
 columns = [row[1] for row in cursor.fetchall()]
 if 'tags' not in columns:
-    get_conn().execute("ALTER TABLE notes ADD COLUMN tags TEXT DEFAULT ''")
+    _writer.execute("ALTER TABLE notes ADD COLUMN tags TEXT DEFAULT ''")
 if 'is_favorite' not in columns:
-    get_conn().execute("ALTER TABLE notes ADD COLUMN is_favorite INTEGER DEFAULT 0")
-get_conn().commit()
+    _writer.execute("ALTER TABLE notes ADD COLUMN is_favorite INTEGER DEFAULT 0")
+# Character offsets of a chunk in the note it was split from; NULL for notes saved before chunk
+# offsets existed and for chunks edited on their own
+if 'chunk_start' not in columns:
+    _writer.execute("ALTER TABLE notes ADD COLUMN chunk_start INTEGER")
+    _writer.execute("ALTER TABLE notes ADD COLUMN chunk_end INTEGER")
+# The embedding provider key emb came from, and the vector for the next provider while reembed() runs
+if 'emb_model' not in columns:
+    _writer.execute("ALTER TABLE notes ADD COLUMN emb_model TEXT")
+    _writer.execute("ALTER TABLE notes ADD COLUMN emb_next BLOB")
+
+# /ask kept its own copy of every note's vector per provider; it searches notes.emb through topk now
+for trigger in ("note_vectors_ad", "note_vectors_au"):
+    _writer.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+_writer.execute("DROP TABLE IF EXISTS note_vectors")
+
+# Persistent embedding cache keyed by (provider key, hash of normalized text), evicted least-recently-used first
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS embed_cache("
+    "model TEXT NOT NULL,"
+    "hash TEXT NOT NULL,"
+    "vec BLOB NOT NULL,"
+    "used REAL NOT NULL,"
+    "PRIMARY KEY(model, hash))"
+)
+_writer.execute("CREATE INDEX IF NOT EXISTS embed_cache_used ON embed_cache(used)")
+
+# Checkpoints for resumable bulk imports: how many records of each source are committed
+_writer.execute("CREATE TABLE IF NOT EXISTS imports(source TEXT PRIMARY KEY, done INTEGER NOT NULL, ts REAL NOT NULL)")
+# The note each exported id became, so chunks committed after a resume still find a parent from an earlier run
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS import_ids(source TEXT NOT NULL, record_id NOT NULL, note_id INTEGER NOT NULL, "
+    "PRIMARY KEY(source, record_id)) WITHOUT ROWID"
+)
+
+# Chunks saved without a vector. The background embedder fills notes.emb and drops the row; next_try is
+# also a lease, so both apps can drain the queue without embedding a chunk twice.
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS embed_queue("
+    "note_id INTEGER PRIMARY KEY,"
+    "attempts INTEGER NOT NULL DEFAULT 0,"
+    "next_try REAL NOT NULL,"
+    "error TEXT)"
+)
+_writer.execute("CREATE INDEX IF NOT EXISTS embed_queue_next ON embed_queue(next_try)")
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS embed_queue_ad AFTER DELETE ON notes
+BEGIN
+  DELETE FROM embed_queue WHERE note_id = old.id;
+END;
+""")
+
+# One row per (note, lower-cased tag); notes.tags keeps the display string
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS note_tags("
+    "note_id INTEGER NOT NULL,"
+    "tag TEXT NOT NULL,"
+    "PRIMARY KEY(note_id, tag)) WITHOUT ROWID"
+)
+_writer.execute("CREATE INDEX IF NOT EXISTS note_tags_tag ON note_tags(tag, note_id)")
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS note_tags_ad AFTER DELETE ON notes
+BEGIN
+  DELETE FROM note_tags WHERE note_id = old.id;
+END;
+""")
+
+def _split_tags(tags: str) -> list[str]:
+    return sorted({tag.strip().lower() for tag in (tags or "").split(",") if tag.strip()})
+
+def _set_tags(conn, ids, tags: str):
+    tag_list = _split_tags(tags)
+    conn.executemany("DELETE FROM note_tags WHERE note_id=?", [(nid,) for nid in ids])
+    conn.executemany("INSERT INTO note_tags(note_id, tag) VALUES(?,?)", [(nid, tag) for nid in ids for tag in tag_list])
+
+# Generated answers keyed by chat model, the context notes with their timestamps and the question's vector.
+# Editing or deleting a note drops every answer it was context for, in either app.
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS answer_cache("
+    "id INTEGER PRIMARY KEY,"
+    "model TEXT NOT NULL,"
+    "context TEXT NOT NULL,"
+    "vec BLOB NOT NULL,"
+    "answer TEXT NOT NULL,"
+    "used REAL NOT NULL)"
+)
+_writer.execute("CREATE INDEX IF NOT EXISTS answer_cache_context ON answer_cache(model, context)")
+_writer.execute("CREATE INDEX IF NOT EXISTS answer_cache_used ON answer_cache(used)")
+_writer.execute(
+    "CREATE TABLE IF NOT EXISTS answer_cache_notes("
+    "note_id INTEGER NOT NULL,"
+    "entry INTEGER NOT NULL,"
+    "PRIMARY KEY(note_id, entry)) WITHOUT ROWID"
+)
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS answer_cache_notes_au AFTER UPDATE OF body, ts ON notes
+BEGIN
+  DELETE FROM answer_cache WHERE id IN (SELECT entry FROM answer_cache_notes WHERE note_id = old.id);
+END;
+""")
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS answer_cache_notes_ad AFTER DELETE ON notes
+BEGIN
+  DELETE FROM answer_cache WHERE id IN (SELECT entry FROM answer_cache_notes WHERE note_id = old.id);
+END;
+""")
+_writer.execute("""
+CREATE TRIGGER IF NOT EXISTS answer_cache_ad AFTER DELETE ON answer_cache
+BEGIN
+  DELETE FROM answer_cache_notes WHERE entry = old.id;
+END;
+""")
+
+# Migrate the comma-separated column once
+if _writer.execute("SELECT NOT EXISTS(SELECT 1 FROM note_tags)").fetchone()[0]:
+    for nid, tags in _writer.execute("SELECT id, tags FROM notes WHERE tags != ''").fetchall():
+        _set_tags(_writer, [nid], tags)
+_writer.commit()
+
+# Settings that describe the stored data, e.g. the emb codec
+_writer.execute("CREATE TABLE IF NOT EXISTS settings(key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+_writer.commit()
+
+def _get_setting(key: str, default=None):
+    with reader() as conn:
+        row = conn.execute("SELECT value FROM settings WHERE key=?", (key,)).fetchone()
+    return json.loads(row[0]) if row else default
+
+def _set_setting(conn, key: str, value):
+    conn.execute("INSERT OR REPLACE INTO settings(key, value) VALUES(?,?)", (key, json.dumps(value)))
+
+VECTOR_CODECS = ("float32", "float16", "int8")
+if VECTOR_CODEC not in VECTOR_CODECS:
+    raise ValueError(f"SECOND_BRAIN_VECTOR_CODEC must be one of {', '.join(VECTOR_CODECS)}")
+
+def _prepare(vec, dims: int = None):
+    # Truncates a provider vector to the stored dimensions and renormalizes it
+    dims = VECTOR_DIMS if dims is None else dims
+    vec = np.asarray(vec, dtype="float32")
+    if dims and 0 < dims < vec.size:
+        vec = vec[:dims]
+        norm = np.linalg.norm(vec)
+        if norm:
+            vec = vec / norm
+    return vec
+
+def _encode(vec, codec: str = None) -> bytes:
+    codec = codec or VECTOR_CODEC
+    if codec == "float16":
+        return vec.astype("float16").tobytes()
+    if codec == "int8":
+        scale = float(np.abs(vec).max()) / 127 or 1.0
+        return np.float32(scale).tobytes() + np.round(vec / scale).astype("int8").tobytes()
+    return vec.astype("float32").tobytes()
+
+def _decode(blob, codec: str = None):
+    codec = codec or VECTOR_CODEC
+    if codec == "float16":
+        return np.frombuffer(blob, dtype="float16").astype("float32")
+    if codec == "int8":
+        return np.frombuffer(blob, dtype="int8", offset=4).astype("float32") * np.frombuffer(blob, dtype="float32", count=1)[0]
+    return np.frombuffer(blob, dtype="float32")
+
+def _blob_dim(size: int, codec: str = None) -> int:
+    codec = codec or VECTOR_CODEC
+    return size // 2 if codec == "float16" else size - 4 if codec == "int8" else size // 4
+
+def _coarse(vecs):
+    # The prefix of stored vectors (a vector or a row matrix) that the HNSW index is built over
+    if not INDEX_DIMS or vecs.shape[-1] <= INDEX_DIMS:
+        return vecs
+    vecs = vecs[..., :INDEX_DIMS]
+    norms = np.linalg.norm(vecs, axis=-1, keepdims=True)
+    return vecs / np.where(norms == 0, 1, norms)
+
+def _index_dim(dim: int) -> int:
+    return min(dim, INDEX_DIMS) if INDEX_DIMS else dim
+
+def _exact_files():
+    return [path for path in APP.glob(VECS.name + "*") if path.suffix != ".lock"]
+
+def migrate_vectors(codec: str = None, dims: int = None, batch: int = 1000):
+    # Re-encodes every stored vector into the configured format, in one transaction so an interrupted run
+    # leaves the vault in the old format. Truncation only shortens vectors; going back to more dimensions
+    # would need the notes re-embedded.
+    codec, dims = codec or VECTOR_CODEC, VECTOR_DIMS if dims is None else dims
+    old = _get_setting("vector_format", {"codec": "float32", "dims": 0})
+    if old == {"codec": codec, "dims": dims}:
+        return 0
+    done, last = 0, 0
+    with writer() as conn:
+        if old["dims"] and (not dims or dims > old["dims"]) and conn.execute(
+                "SELECT 1 FROM notes WHERE emb IS NOT NULL LIMIT 1").fetchone():
+            raise ValueError(f"notes.emb holds {old['dims']}-dimension vectors; SECOND_BRAIN_VECTOR_DIMS={dims} "
+                             f"would need every note re-embedded, so keep SECOND_BRAIN_VECTOR_DIMS={old['dims']}")
+        while True:
+            rows = conn.execute("SELECT id, emb FROM notes WHERE id > ? AND emb IS NOT NULL ORDER BY id LIMIT ?",
+                                (last, batch)).fetchall()
+            conn.executemany("UPDATE notes SET emb=? WHERE id=?",
+                             [(_encode(_prepare(_decode(blob, old["codec"]), dims), codec), nid) for nid, blob in rows])
+            done += len(rows)
+            if len(rows) < batch:
+                break
+            last = rows[-1][0]
+        _set_setting(conn, "vector_format", {"codec": codec, "dims": dims})
+    # The saved indexes were built from the old vectors
+    for path in (INDEX_META, INDEX, *_exact_files()):
+        path.unlink(missing_ok=True)
+    return done
+
+def _open_vault():
+    # Every running app holds a shared lock on the vault and reads and writes notes.emb in one format.
+    # Only an app that has the vault to itself may re-encode it into another one.
+    lock = open(APP / "second_brain.lock", "a")
+    if fcntl is None:
+        migrate_vectors()
+        return lock
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    stored = _get_setting("vector_format", {"codec": "float32", "dims": 0})
+    if stored != {"codec": VECTOR_CODEC, "dims": VECTOR_DIMS}:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            raise RuntimeError(
+                f"The vault stores vectors as {stored['codec']} with dims={stored['dims']}, but this app is set "
+                f"to {VECTOR_CODEC} with dims={VECTOR_DIMS}. Quit the other Second Brain apps to migrate it, or "
+                f"start with the same SECOND_BRAIN_VECTOR_CODEC and SECOND_BRAIN_VECTOR_DIMS.") from None
+        migrate_vectors()
+        fcntl.flock(lock, fcntl.LOCK_SH)
+    return lock
+
+_vault_lock = _open_vault()  # held until the process exits
+
+# Vaults from before emb_model was recorded were embedded by Ollama's nomic-embed-text, whatever provider is
+# configured now; reembed_status() reports them as stale under another one. A vault without vectors yet
+# belongs to the provider of the first app that opens it.
+if _get_setting("emb_model") is None:
+    with writer() as conn:
+        if conn.execute("SELECT 1 FROM settings WHERE key='emb_model'").fetchone() is None:
+            legacy = conn.execute("SELECT 1 FROM notes WHERE emb IS NOT NULL LIMIT 1").fetchone() is not None
+            model = "ollama:nomic-embed-text" if legacy else get_embedder().key
+            conn.execute("UPDATE notes SET emb_model=? WHERE emb IS NOT NULL AND emb_model IS NULL", (model,))
+            _set_setting(conn, "emb_model", model)
+_search_model = _get_setting("emb_model")  # the model the search structures and their snapshots hold
 
 _index = None
 _DIM = 0
+# Marks of the rows replayed from the database into _index. Vectors this process adds don't move them, so
+# rows the other app wrote in between are still caught up before a snapshot is saved.
+_index_hwm = 0.0  # newest notes.ts replayed
+_index_max_id = 0  # highest notes.id replayed
+_index_dirty = 0  # writes since the last snapshot
+_index_deleted = set()  # labels marked deleted in _index
+_index_lock = threading.RLock()
+_compacting = None  # background rebuild thread, if one is running
+_compact_written = set()  # ids this process added to the old index while the rebuild ran
+
+class _SearchGate:
+    # Searches run concurrently with add_items, but resize_index reallocates the index under them:
+    # a resize waits for running searches and holds new ones off until it is done.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._searches = 0
+        self._resizing = False
+
+    @contextmanager
+    def search(self):
+        with self._cond:
+            while self._resizing:
+                self._cond.wait()
+            self._searches += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._searches -= 1
+                if not self._searches:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def resize(self):
+        with self._cond:
+            self._resizing = True
+            while self._searches:
+                self._cond.wait()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._resizing = False
+                self._cond.notify_all()
+
+_search_gate = _SearchGate()
+
+def _new_index(dim: int):
+    idx = hnswlib.Index(space="ip", dim=dim)
+    idx.init_index(max_elements=INDEX_CAPACITY, ef_construction=200, M=32)
+    idx.set_ef(100)
+    return idx
+
+def _reserve(idx, n: int):
+    # Grows idx geometrically so n more labels fit
+    needed = idx.get_current_count() + n
+    capacity = idx.get_max_elements()
+    if needed <= capacity:
+        return
+    while capacity < needed:
+        capacity *= 2
+    if idx is _index:
+        with _search_gate.resize():
+            idx.resize_index(capacity)
+    else:
+        idx.resize_index(capacity)
+
+def _tombstone_missing(idx):
+    # Marks labels whose rows are gone (or lost their vector) as deleted and returns every deleted label.
+    with reader() as conn:
+        live = {nid for (nid,) in conn.execute("SELECT id FROM notes WHERE emb IS NOT NULL")}
+    deleted = set()
+    for label in idx.get_ids_list():
+        if label not in live:
+            try:
+                idx.mark_deleted(label)
+            except RuntimeError:
+                pass  # already deleted
+            deleted.add(label)
+    return deleted
+
+def _load_snapshot():
+    # Returns (index, dim, hwm, max_id, deleted) for a snapshot that still matches the notes table, else None.
+    try:
+        meta = json.loads(INDEX_META.read_text())
+    except (OSError, ValueError):
+        return None
+    with reader() as conn:
+        max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM notes").fetchone()[0]
+    if max_id < meta.get("max_id", 0):
+        # The database was replaced or rolled back behind the snapshot's back.
+        return None
+    if meta.get("index_dims", 0) != INDEX_DIMS or meta.get("model") != _search_model:
+        return None
+    try:
+        idx = hnswlib.Index(space="ip", dim=meta["dim"])
+        idx.load_index(str(INDEX))
+    except (RuntimeError, KeyError):
+        return None
+    idx.set_ef(100)
+    return idx, meta["dim"], meta["hwm"], meta.get("max_id", 0), _tombstone_missing(idx)
+
+def _replay(idx, dim: int, since: float, since_id: int):
+    # Adds every row written or inserted after the marks to idx and returns the new (hwm, max_id).
+    # Bulk imports keep their original timestamps, so new ids are replayed as well as new ts.
+    hwm, max_id = since, since_id
+    with reader() as conn:
+        cur = conn.execute("SELECT id, emb, ts FROM notes WHERE emb IS NOT NULL AND (ts > ? OR id > ?)",
+                           (since, since_id))
+        while True:
+            rows = cur.fetchmany(1024)
+            if not rows:
+                break
+            ids, vecs = [], []
+            for nid, blob, ts in rows:
+                hwm = max(hwm, ts)
+                max_id = max(max_id, nid)
+                if isinstance(blob, (bytes, bytearray)) and _index_dim(_blob_dim(len(blob))) == dim:
+                    ids.append(nid)
+                    vecs.append(_decode(blob))
+            if ids:
+                _reserve(idx, len(ids))
+                idx.add_items(_coarse(np.vstack(vecs)), ids)
+        cur.close()
+    return hwm, max_id
+
+def _readd(idx, dim: int, ids):
+    # Adds the current vectors of ids to idx
+    ids = list(ids)
+    with reader() as conn:
+        for start in range(0, len(ids), 500):
+            part = ids[start:start + 500]
+            rows = [(nid, blob) for nid, blob in conn.execute(
+                f"SELECT id, emb FROM notes WHERE emb IS NOT NULL AND id IN ({','.join('?' * len(part))})", part)
+                if _index_dim(_blob_dim(len(blob))) == dim]
+            if rows:
+                _reserve(idx, len(rows))
+                idx.add_items(_coarse(np.vstack([_decode(blob) for _, blob in rows])), [nid for nid, _ in rows])
+
+def _ensure_index(dim: int = None):
+    global _index, _DIM, _index_hwm, _index_max_id, _index_dirty, _index_deleted
+    if _index is not None:
+        return
+    with _index_lock:
+        if _index is not None:
+            return
+        snapshot = _load_snapshot()
+        if snapshot and dim is not None and snapshot[1] != dim:
+            snapshot = None
+        if snapshot:
+            idx, dim, hwm, max_id, deleted = snapshot
+        else:
+            if dim is None:
+                with reader() as conn:
+                    row = conn.execute(
+                        "SELECT LENGTH(emb) FROM notes WHERE emb IS NOT NULL ORDER BY ts DESC LIMIT 1").fetchone()
+                if row is None:
+                    return
+                dim = _index_dim(_blob_dim(row[0]))
+            idx, hwm, max_id, deleted = _new_index(dim), 0.0, 0, set()
+        new_hwm, new_max_id = _replay(idx, dim, hwm, max_id)
+        _index, _DIM, _index_hwm, _index_max_id = idx, dim, new_hwm, new_max_id
+        _index_deleted = deleted
+        if snapshot is None or (new_hwm, new_max_id) != (hwm, max_id):
+            _index_dirty = INDEX_FLUSH_EVERY
+    flush_index()
+    _maybe_compact()
 
-def _ensure_index(dim: int):
-    global _index, _DIM
+def _maybe_compact():
+    global _compacting
+    with _index_lock:
+        if _index is None or _compacting is not None:
+            return
+        deleted = len(_index_deleted)
+        if deleted < COMPACT_MIN_DELETED or deleted < COMPACT_RATIO * _index.get_current_count():
+            return
+        _compact_written.clear()
+        _compacting = threading.Thread(target=_compact, daemon=True, name="index-compaction")
+        _compacting.start()
+
+def _compact():
+    # Builds a fresh index from the live vectors without holding the lock, so searches and writes go on
+    # against the old one. Rows written meanwhile are caught up from the database under the lock, then
+    # the new index replaces the old in one assignment; searches already running finish on the old one.
+    global _index, _index_hwm, _index_max_id, _index_dirty, _index_deleted, _compacting
+    try:
+        old, dim = _index, _DIM
+        idx = _new_index(dim)
+        hwm, max_id = _replay(idx, dim, 0.0, 0)
+        with _index_lock:
+            if _index is not old:
+                return  # reset by a re-embedding cutover
+            hwm, max_id = _replay(idx, dim, hwm, max_id)
+            # A chunk queued before the rebuild and embedded during it is below both marks
+            _readd(idx, dim, _compact_written)
+            _compact_written.clear()
+            deleted = _tombstone_missing(idx)
+            _index, _index_deleted = idx, deleted
+            _index_hwm, _index_max_id = max(_index_hwm, hwm), max(_index_max_id, max_id)
+            _index_dirty = INDEX_FLUSH_EVERY
+        flush_index()
+    finally:
+        _compacting = None
+
+def index_stats():
+    if _backend == "exact":
+        view = _exact.view
+        rows, live = (len(view[0]), view[3]) if view else (0, 0)
+        return {"backend": "exact", "elements": rows, "capacity": rows, "deleted": rows - live,
+                "deleted_ratio": (rows - live) / rows if rows else 0.0, "compacting": False}
+    with _index_lock:
+        if _index is None:
+            return {"backend": _backend, "elements": 0, "capacity": 0, "deleted": 0, "deleted_ratio": 0.0,
+                    "compacting": False}
+        elements = _index.get_current_count()
+        return {
+            "backend": "hnsw",
+            "elements": elements,
+            "capacity": _index.get_max_elements(),
+            "deleted": len(_index_deleted),
+            "deleted_ratio": len(_index_deleted) / elements if elements else 0.0,
+            "compacting": _compacting is not None,
+        }
+
+def _exact_slot():
+    # Each running app appends to its own exact-index files, so neither sees the other's rows half
+    # written or its files replaced during compaction. The lock is held until the process exits.
+    for slot in itertools.count():
+        base = VECS if slot == 0 else VECS.with_name(f"{VECS.name}.{slot}")
+        lock = open(base.with_name(base.name + ".lock"), "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+        return lock, base, base.with_name(base.name + ".ids"), base.with_name(base.name + ".json")
+
+class _ExactIndex:
+    # Every stored vector in an append-only, memory-mapped matrix with a parallel id array. An update
+    # appends a newer row for its id, deletes are masked out, and flush() rewrites the files once a
+    # fifth of the rows are dead. Search scores the whole matrix with one product per block.
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.dim = 0
+        self.dtype = "float32"
+        self.rows = 0
+        self.hwm = 0.0
+        self.max_id = 0
+        self.deleted = set()
+        self.added = {}  # id -> ts of the appended rows the marks don't cover yet
+        self.dirty = 0
+        self.slot = None  # (lock, vecs, ids, meta) files, claimed on first load
+        self.view = None  # (ids, matrix, valid rows, live count), replaced whole on every change
+
+    def load(self):
+        with self.lock:
+            if self.view is not None:
+                return
+            if self.slot is None:
+                self.slot = _exact_slot()
+            _, vecs, ids, meta_path = self.slot
+            self.dtype = "float32" if VECTOR_CODEC == "float32" else "float16"
+            try:
+                meta = json.loads(meta_path.read_text())
+            except (OSError, ValueError):
+                meta = {}
+            with reader() as conn:
+                max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM notes").fetchone()[0]
+            fresh = (meta.get("dtype") == self.dtype and meta.get("max_id", 0) <= max_id and meta.get("dim")
+                     and meta.get("model") == _search_model and vecs.exists() and ids.exists())
+            if fresh:
+                self.dim, self.hwm, self.max_id = meta["dim"], meta["hwm"], meta["max_id"]
+                # Whole rows present in both files; anything after the marks is replayed from the database
+                self.rows = min(ids.stat().st_size // 8,
+                                vecs.stat().st_size // (self.dim * np.dtype(self.dtype).itemsize))
+                with open(vecs, "r+b") as f:
+                    f.truncate(self.rows * self.dim * np.dtype(self.dtype).itemsize)
+                with open(ids, "r+b") as f:
+                    f.truncate(self.rows * 8)
+            else:
+                self.dim, self.rows, self.hwm, self.max_id = 0, 0, 0.0, 0
+                vecs.write_bytes(b"")
+                ids.write_bytes(b"")
+                self.dirty = INDEX_FLUSH_EVERY
+            self.added = {}
+            self._catch_up()
+            with reader() as conn:
+                live = {nid for (nid,) in conn.execute("SELECT id FROM notes WHERE emb IS NOT NULL")}
+            self._remap()
+            self.deleted = set(np.unique(self.view[0]).tolist()) - live
+            self._remap()
+        self.flush()
+
+    def _catch_up(self):
+        # Appends every row committed after the marks, by this app or the other one, and advances them.
+        # max_id stays below the queued chunks, which get their vectors after later ids.
+        with reader() as conn:
+            cur = conn.execute("SELECT id, emb, ts FROM notes WHERE emb IS NOT NULL AND (ts > ? OR id > ?)",
+                               (self.hwm, self.max_id))
+            while True:
+                rows = cur.fetchmany(1024)
+                if not rows:
+                    break
+                self.hwm = max(self.hwm, max(ts for _, _, ts in rows))
+                self.max_id = max(self.max_id, max(nid for nid, _, _ in rows))
+                rows = [row for row in rows if self.added.get(row[0], -1.0) < row[2]]  # appended already
+                self.added.update((nid, ts) for nid, _, ts in rows)
+                self.dirty += len(rows)
+                self._append([nid for nid, _, _ in rows], [_decode(blob) for _, blob, _ in rows])
+            cur.close()
+        self.max_id = _watermark(self.max_id)
+        self.added = {nid: ts for nid, ts in self.added.items() if nid > self.max_id or ts > self.hwm}
+
+    def catch_up(self):
+        with self.lock:
+            if self.view is None:
+                return
+            rows = self.rows
+            self._catch_up()
+            if self.rows != rows:
+                self._remap()
+
+    def _append(self, ids, vecs):
+        if not self.dim and vecs:
+            self.dim = vecs[0].size
+        kept = [(nid, vec) for nid, vec in zip(ids, vecs) if vec.size == self.dim]
+        if not kept:
+            return
+        _, vecs_path, ids_path, _ = self.slot
+        with open(vecs_path, "ab") as f:
+            f.write(np.vstack([vec for _, vec in kept]).astype(self.dtype).tobytes())
+        with open(ids_path, "ab") as f:
+            f.write(np.array([nid for nid, _ in kept], dtype=np.int64).tobytes())
+        self.rows += len(kept)
+        self.deleted.difference_update(nid for nid, _ in kept)
+
+    def _remap(self):
+        if not self.rows:
+            self.view = (np.empty(0, dtype=np.int64), np.empty((0, self.dim), dtype=self.dtype),
+                         np.empty(0, dtype=bool), 0)
+            return
+        _, vecs_path, ids_path, _ = self.slot
+        ids = np.memmap(ids_path, dtype=np.int64, mode="r", shape=(self.rows,))
+        matrix = np.memmap(vecs_path, dtype=self.dtype, mode="r", shape=(self.rows, self.dim))
+        # Only the newest row of each id counts
+        _, newest = np.unique(ids[::-1], return_index=True)
+        valid = np.zeros(self.rows, dtype=bool)
+        valid[self.rows - 1 - newest] = True
+        if self.deleted:
+            valid &= ~np.isin(ids, np.fromiter(self.deleted, dtype=np.int64, count=len(self.deleted)))
+        self.view = (ids, matrix, valid, int(valid.sum()))
+
+    def add(self, ids, vecs, ts: float):
+        with self.lock:
+            if self.view is None:
+                return  # load() replays it from the database
+            self._append(ids, vecs)
+            self.added.update(dict.fromkeys(ids, ts))
+            self.dirty += len(ids)
+            self._remap()
+            due = self.dirty >= INDEX_FLUSH_EVERY
+        if due:
+            self.flush()
+
+    def remove(self, ids):
+        with self.lock:
+            if self.view is None:
+                return
+            self.deleted.update(ids)
+            self.dirty += len(ids)
+            self._remap()
+
+    def count(self) -> int:
+        return self.view[3] if self.view else 0
+
+    def search(self, vec, k: int, allowed=None):
+        # allowed: optional array of the ids the results must come from
+        ids, matrix, valid, live = self.view
+        if allowed is not None:
+            valid = valid & np.isin(ids, allowed)
+            live = int(valid.sum())
+        k = min(k, live)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype="float32")
+        similarities = np.empty(len(ids), dtype="float32")
+        for start in range(0, len(ids), EXACT_BLOCK):
+            similarities[start:start + EXACT_BLOCK] = np.asarray(matrix[start:start + EXACT_BLOCK], dtype="float32") @ vec
+        similarities[~valid] = -np.inf
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return np.asarray(ids[top]), similarities[top]
+
+    def flush(self):
+        with self.lock:
+            if self.view is None or not self.dirty:
+                return
+            # The saved marks promise every row up to them is in the files, including the other app's
+            self._catch_up()
+            self._remap()
+            _, vecs_path, ids_path, meta_path = self.slot
+            ids, matrix, valid, live = self.view
+            if self.rows - live > max(COMPACT_MIN_DELETED, COMPACT_RATIO * self.rows):
+                for path, data in ((vecs_path, matrix[valid]), (ids_path, ids[valid])):
+                    tmp = path.with_name(path.name + ".tmp")
+                    np.asarray(data).tofile(tmp)
+                    os.replace(tmp, path)
+                self.rows, self.deleted = live, set()
+                self._remap()
+            tmp = meta_path.with_name(meta_path.name + ".tmp")
+            tmp.write_text(json.dumps({"dim": self.dim, "dtype": self.dtype, "rows": self.rows,
+                                       "hwm": self.hwm, "max_id": _watermark(self.max_id), "model": _search_model}))
+            os.replace(tmp, meta_path)
+            self.dirty = 0
+
+    def reset(self):
+        # Forgets the loaded matrix; the next load() rebuilds the files if their meta is for another model
+        with self.lock:
+            self.view = None
+            self.dirty = 0
+
+    def drop(self):
+        with self.lock:
+            self.view = None
+            if self.slot is not None:
+                for path in self.slot[1:]:
+                    path.unlink(missing_ok=True)
+
+_exact = _ExactIndex()
+_backend = None
+
+def _search_backend() -> str:
+    # Chosen once per process from the vault size; an auto vault that outgrows EXACT_MAX moves to HNSW
+    global _backend
+    if _backend is None:
+        if SEARCH_BACKEND in ("exact", "hnsw"):
+            _backend = SEARCH_BACKEND
+        else:
+            with reader() as conn:
+                count = conn.execute("SELECT COUNT(*) FROM notes WHERE emb IS NOT NULL").fetchone()[0]
+            _backend = "exact" if count <= EXACT_MAX else "hnsw"
+    if _backend == "exact":
+        _exact.load()
+    return _backend
+
+def _vectors_written(ids, vecs, ts: float):
+    # Mirrors committed vectors into whichever search structures are live
+    global _backend
+    if _search_backend() == "exact":
+        _exact.add(ids, vecs, ts)
+        if SEARCH_BACKEND == "auto" and _exact.count() > EXACT_MAX:
+            _backend = "hnsw"
+            _ensure_index()
+            _exact.drop()
+        return
     if _index is None:
-        _DIM = dim
-        idx = hnswlib.Index(space="ip", dim=_DIM)
-        idx.init_index(max_elements=100_000, ef_construction=200, M=32)
-        idx.set_ef(100)
-        rows = get_conn().execute("SELECT id, emb FROM notes WHERE emb IS NOT NULL").fetchall()
-        for nid, blob in rows:
-            if isinstance(blob, (bytes, bytearray)) and len(blob) == _DIM * 4:
-                vec = np.frombuffer(blob, dtype="float32")
-                idx.add_items(vec.reshape(1, -1), [nid])
-        _index = idx
+        _ensure_index(_index_dim(vecs[0].size))  # replays the rows just written
+    else:
+        with _index_lock:
+            _reserve(_index, len(ids))
+            # add_items replaces (and undeletes) an existing label, and also covers rows that had no vector
+            _index.add_items(_coarse(np.vstack(vecs)), ids)
+            _index_deleted.difference_update(ids)
+            if _compacting is not None:
+                _compact_written.update(ids)
+    _index_written(len(ids))
+
+def _vectors_deleted(ids):
+    _exact.remove(ids)
+    if _index is not None:
+        with _index_lock:
+            for nid in ids:
+                try:
+                    _index.mark_deleted(nid)
+                    _index_deleted.add(nid)
+                except RuntimeError:
+                    pass  # chunk without a vector
+        _index_written(len(ids))
+        _maybe_compact()
+
+def _index_written(n: int = 1):
+    global _index_dirty
+    with _index_lock:
+        _index_dirty += max(n, 1)
+        due = _index_dirty >= INDEX_FLUSH_EVERY
+    if due:
+        flush_index()
+
+def flush_index():
+    global _index_dirty, _index_hwm, _index_max_id
+    _exact.flush()
+    with _index_lock:
+        if _index is None or not _index_dirty:
+            return
+        # The saved marks promise every row up to them is in the snapshot, including the other app's
+        _index_hwm, _index_max_id = _replay(_index, _DIM, _index_hwm, _index_max_id)
+        _index_max_id = _watermark(_index_max_id)
+        tmp = INDEX.with_name(INDEX.name + ".tmp")
+        _index.save_index(str(tmp))
+        os.replace(tmp, INDEX)
+        tmp = INDEX_META.with_name(INDEX_META.name + ".tmp")
+        tmp.write_text(json.dumps({"dim": _DIM, "hwm": _index_hwm, "max_id": _watermark(_index_max_id),
+                                   "index_dims": INDEX_DIMS, "model": _search_model}))
+        os.replace(tmp, INDEX_META)
+        _index_dirty = 0
+
+atexit.register(flush_index)
+
+_fts_writes = 0
+
+def _fts_written(n: int = 1):
+    # Incrementally merges FTS segments every FTS_MERGE_EVERY writes so queries don't fan out over many of them.
+    global _fts_writes
+    _fts_writes += n
+    if _fts_writes >= FTS_MERGE_EVERY:
+        _fts_writes = 0
+        with writer() as conn:
+            for name in FTS_TABLES:
+                conn.execute(f"INSERT INTO {name}({name}, rank) VALUES('merge', 500)")
+
+def fts_optimize():
+    # Merges every FTS segment into one; run after bulk imports.
+    with writer() as conn:
+        for name in FTS_TABLES:
+            conn.execute(f"INSERT INTO {name}({name}) VALUES('optimize')")
 
 def _normalize(text: str) -> str:
     text = text.lower()
     text = re.sub(r'[^\w\s]', '', text)
     return text
 
-def _chunk(text, max_words=100):
-    words = text.split()
-    if len(words) <= max_words:
-        yield text
-    else:
-        for i in range(0, len(words), max_words):
-            yield " ".join(words[i:i + max_words])
+_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n\s*\n")
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+
+def _sentences(text, max_tokens: int):
+    # Yields contiguous (start, end, tokens, paragraph_end) spans covering text, one per sentence with its
+    # trailing whitespace. Sentences longer than max_tokens are cut between tokens.
+    pos = 0
+    for m in itertools.chain(_BOUNDARY.finditer(text), [None]):
+        end = m.end() if m else len(text)
+        if end <= pos:
+            continue
+        paragraph = m is None or m.group().count("\n") >= 2
+        starts = [t.start() for t in _TOKEN.finditer(text, pos, end)]
+        for i in range(0, max(len(starts), 1), max_tokens):
+            piece_end = starts[i + max_tokens] if i + max_tokens < len(starts) else end
+            yield pos, piece_end, len(starts[i:i + max_tokens]), paragraph and piece_end == end
+            pos = piece_end
+
+def _chunk(text, max_tokens: int = CHUNK_TOKENS, overlap: int = CHUNK_OVERLAP):
+    # Yields (start, end) offsets of chunks made of whole sentences, at most max_tokens each (counted
+    # approximately as words and punctuation). A chunk also ends at a paragraph break once it is half
+    # full. Otherwise the next chunk starts with the last sentences of this one, up to `overlap` tokens.
+    window, size, fresh = deque(), 0, False
+    for start, end, tokens, paragraph in _sentences(text, max_tokens):
+        if fresh and size + tokens > max_tokens:
+            yield window[0][0], window[-1][1]
+            carry, kept = deque(), 0
+            while window and kept + window[-1][2] <= overlap and kept + window[-1][2] + tokens <= max_tokens:
+                sentence = window.pop()
+                carry.appendleft(sentence)
+                kept += sentence[2]
+            window, size, fresh = carry, kept, False
+        window.append((start, end, tokens))
+        size += tokens
+        fresh = True
+        if paragraph and size >= max_tokens // 2:
+            yield window[0][0], window[-1][1]
+            window, size, fresh = deque(), 0, False
+    if fresh:
+        yield window[0][0], window[-1][1]
+
+def note_text(nid: int):
+    # Reassembles the whole note a chunk belongs to, keeping text shared by overlapping chunks once
+    with reader() as conn:
+        row = conn.execute("SELECT COALESCE(parent_id, id) FROM notes WHERE id=?", (nid,)).fetchone()
+        if row is None:
+            return None
+        rows = conn.execute("SELECT body, chunk_start, chunk_end FROM notes WHERE id=? OR parent_id=? ORDER BY id",
+                            (row[0], row[0])).fetchall()
+    return _join_chunks(rows)
+
+def _join_chunks(rows):
+    # rows of (body, chunk_start, chunk_end) in note order; chunks that don't touch go on separate lines
+    parts, covered = [], None
+    for body, start, end in rows:
+        if start is None or covered is None or start > covered:
+            parts.append(body if not parts else "\n" + body)
+        else:
+            parts.append(body[max(covered - start, 0):])
+        covered = end
+    return "".join(parts)
+
+def _passages(text: str, terms, max_tokens: int):
+    # The sentences of text sharing the most words with the query that fit in max_tokens, in their original
+    # order, gaps marked with an ellipsis
+    sentences = list(_sentences(text, max_tokens))
+    if sum(tokens for _, _, tokens, _ in sentences) <= max_tokens:
+        return text.strip()
+    # Long sentences are split one token short so each piece still fits with its ellipsis
+    sentences = list(_sentences(text, max(max_tokens - 1, 1)))
+    def score(i):
+        words = _normalize(text[sentences[i][0]:sentences[i][1]]).split()
+        return -len(terms.intersection(words)), -sum(w in terms for w in words), i
+    kept, size = [], 0
+    for i in sorted(range(len(sentences)), key=score):
+        # One token more per sentence leaves room for the ellipsis
+        if size + sentences[i][2] + 1 <= max_tokens:
+            kept.append(i)
+            size += sentences[i][2] + 1
+    out, last = [], None
+    for i in sorted(kept):
+        piece = text[sentences[i][0]:sentences[i][1]].strip()
+        out.append(piece if last is None or last == i - 1 else "… " + piece)
+        last = i
+    return " ".join(out)
+
+def pack_context(query: str, hits, budget: int = CONTEXT_TOKENS):
+    # Turns ranked (nid, body) search hits into prompt context that fits in `budget` tokens: chunks of one
+    # note are merged under the best-ranked chunk's id, and each note is cut down to its passages that best
+    # match the query, filling the budget in relevance order.
+    if not hits:
+        return []
+    ids = [nid for nid, _ in hits]
+    with reader() as conn:
+        rows = {nid: rest for nid, *rest in conn.execute(
+            f"SELECT id, COALESCE(parent_id, id), chunk_start, chunk_end FROM notes "
+            f"WHERE id IN ({','.join('?' * len(ids))})", ids)}
+    groups = {}
+    for nid, body in hits:
+        parent, start, end = rows.get(nid, (nid, None, None))
+        groups.setdefault(parent, []).append((nid, body, start, end))
+    terms = {w for w in _normalize(query or "").split() if len(w) > 2}
+    packed = []
+    for chunks in groups.values():
+        allowance = min(budget, CONTEXT_NOTE_TOKENS)
+        if allowance < CONTEXT_MIN_TOKENS:
+            break
+        # Overlapping chunks of one note are joined in note order so shared sentences appear once
+        ordered = sorted(chunks, key=lambda c: (c[2] is None, c[2] or 0))
+        text = _passages(_join_chunks([c[1:] for c in ordered]), terms, allowance)
+        if not text:
+            continue
+        budget -= len(_TOKEN.findall(text))
+        packed.append((chunks[0][0], text))
+    return packed
 
 def add(body: str, tags: str = ""):
+    # Saves the chunks without vectors and returns; the background embedder adds them to search
     ts = time.time()
+    ids = []
     parent = None
-    for chunk in _chunk(body):
-        normalized_chunk = _normalize(chunk)
-        vec = np.array(embed(normalized_chunk), dtype="float32")
-        if vec.size == 0:
-            continue
-        _ensure_index(vec.size)
-        blob = vec.tobytes()
-        cur = get_conn().execute(
-            "INSERT INTO notes(parent_id, body, ts, emb, tags, is_favorite) VALUES(?,?,?,?,?,0)",
-            (parent, chunk, ts, blob, tags))
-        nid = cur.lastrowid
-        if parent is None:
-            parent = nid
-        get_conn().commit()
-        _index.add_items(vec.reshape(1, -1), [nid])
+    with writer() as conn:
+        for start, end in _chunk(body):
+            cur = conn.execute(
+                "INSERT INTO notes(parent_id, body, ts, emb, tags, is_favorite, chunk_start, chunk_end) "
+                "VALUES(?,?,?,NULL,?,0,?,?)",
+                (parent, body[start:end], ts, tags, start, end))
+            nid = cur.lastrowid
+            if parent is None:
+                parent = nid
+            ids.append(nid)
+        if not ids:
+            return
+        _set_tags(conn, ids, tags)
+        _enqueue(conn, ids)
+    _bump_generation()
+    _fts_written(len(ids))
+    _wake_embedder()
 
 def update_note(nid: int, body: str, tags: str = ""):
     ts = time.time()
-    normalized_body = _normalize(body)
-    vec = np.array(embed(normalized_body), dtype="float32")
-    _ensure_index(vec.size)
-    blob = vec.tobytes()
-    get_conn().execute(
-        "UPDATE notes SET body=?, ts=?, emb=?, tags=? WHERE id=?",
-        (body, ts, blob, tags, nid)
-    )
-    get_conn().commit()
-    if _index:
-        _index.mark_deleted(nid)
-        _index.add_items(vec.reshape(1, -1), [nid])
+    with writer() as conn:
+        conn.execute(
+            "UPDATE notes SET body=?, ts=?, emb=NULL, emb_model=NULL, emb_next=NULL, tags=?, chunk_start=NULL, "
+            "chunk_end=NULL WHERE id=?",
+            (body, ts, tags, nid)
+        )
+        _set_tags(conn, [nid], tags)
+        _enqueue(conn, [nid])
+    # The old vector no longer matches the body; keyword search still finds the note until it is re-embedded
+    _vectors_deleted([nid])
+    _bump_generation()
+    _fts_written()
+    _wake_embedder()
 
 def get_note(nid):
-    row = get_conn().execute("SELECT body, tags, is_favorite FROM notes WHERE id=?", (nid,)).fetchone()
+    with reader() as conn:
+        row = conn.execute("SELECT body, tags, is_favorite FROM notes WHERE id=?", (nid,)).fetchone()
     return {"body": row[0], "tags": row[1], "is_favorite": bool(row[2])} if row else None
 
-@lru_cache(maxsize=128)
-def _embed(text: str) -> np.ndarray:
-    normalized_text = _normalize(text)
-    return np.array(embed(normalized_text), dtype="float32")
+def _enqueue(conn, ids):
+    conn.executemany("INSERT OR REPLACE INTO embed_queue(note_id, attempts, next_try, error) VALUES(?,0,0,NULL)",
+                     [(nid,) for nid in ids])
+
+_embedder = None
+_embedder_lock = threading.Lock()
+_embedder_wake = threading.Event()
+_embedding = set()  # claimed ids whose vectors may not be in the search structures yet
+
+def _wake_embedder():
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = threading.Thread(target=_embed_queued, daemon=True, name="embed-queue")
+            _embedder.start()
+    _embedder_wake.set()
+
+def _watermark(max_id: int) -> int:
+    # Queued chunks get their vectors after later ids were indexed, so a saved max_id stays below the
+    # first of them and a restart replays them
+    with _embedder_lock:
+        first = min(_embedding, default=None)
+    with reader() as conn:
+        queued = conn.execute("SELECT MIN(note_id) FROM embed_queue").fetchone()[0]
+    for nid in (first, queued):
+        if nid is not None:
+            max_id = min(max_id, nid - 1)
+    return max_id
+
+def _claim(limit: int):
+    # Returns ([(id, attempts, body)] due now, next due time) and leases the claimed rows
+    now = time.time()
+    with writer() as conn:
+        rows = conn.execute(
+            "SELECT note_id, attempts, body FROM embed_queue JOIN notes ON notes.id = note_id "
+            "WHERE next_try <= ? ORDER BY note_id LIMIT ?", (now, limit)).fetchall()
+        conn.executemany("UPDATE embed_queue SET next_try=? WHERE note_id=?",
+                         [(now + EMBED_LEASE, nid) for nid, _, _ in rows])
+        due = conn.execute("SELECT MIN(next_try) FROM embed_queue").fetchone()[0]
+        with _embedder_lock:
+            _embedding.update(nid for nid, _, _ in rows)
+    return rows, due
+
+def _embed_queued():
+    # Never exits: a failed round (e.g. the database stayed locked) is logged, recorded on the claimed rows
+    # when possible and retried after a growing pause
+    failures = 0
+    while True:
+        rows = []
+        try:
+            rows, due = _claim(CHUNK_EMBED_BATCH)
+            if not rows:
+                _embedder_wake.wait(EMBED_RETRY_MAX if due is None
+                                    else min(max(due - time.time(), 0.0), EMBED_RETRY_MAX))
+                _embedder_wake.clear()
+                continue
+            _embed_rows(rows)
+            failures = 0
+        except Exception as e:
+            logger.exception("Embedding queue round failed")
+            try:
+                with writer() as conn:
+                    _retry_later(conn, rows, f"{type(e).__name__}: {e}")
+            except Exception:
+                pass
+            _embedder_wake.wait(min(EMBED_RETRY_BASE * 2 ** failures, EMBED_RETRY_MAX))
+            _embedder_wake.clear()
+            failures += 1
+        finally:
+            with _embedder_lock:
+                _embedding.difference_update(nid for nid, _, _ in rows)
+
+def _retry_later(conn, rows, error: str):
+    now = time.time()
+    conn.executemany("UPDATE embed_queue SET attempts=?, next_try=?, error=? WHERE note_id=?",
+                     [(attempts + 1, now + min(EMBED_RETRY_BASE * 2 ** attempts, EMBED_RETRY_MAX), error, nid)
+                      for nid, attempts, _ in rows])
+
+def _embed_rows(rows):
+    embedder = get_embedder()
+    active = _get_setting("emb_model")
+    if embedder.key != active:
+        # The vault was re-embedded with another provider; the app using that one embeds these
+        with writer() as conn:
+            _retry_later(conn, rows, f"{embedder.key} is not the vault's model {active}")
+        return
+    try:
+        vecs = [_prepare(v) for v in _embed_cached([_normalize(body) for _, _, body in rows], embedder)]
+        error = "empty embedding"
+    except Exception as e:
+        vecs, error = [np.empty(0, dtype="float32")] * len(rows), f"{type(e).__name__}: {e}"
+    ids, kept, ts = [], [], 0.0
+    with writer() as conn:
+        _retry_later(conn, [row for row, vec in zip(rows, vecs) if vec.size == 0], error)
+        for (nid, attempts, body), vec in zip(rows, vecs):
+            if vec.size == 0:
+                continue
+            # A note edited meanwhile was queued again and is left for the next round; one that has a vector
+            # already got it from a re-embedding cutover, and one left after a cutover to another model waits
+            # for the app using it
+            if not conn.execute("UPDATE notes SET emb=?, emb_model=? WHERE id=? AND body=? AND emb IS NULL AND "
+                                "(SELECT value FROM settings WHERE key='emb_model') = ?",
+                                (_encode(vec), embedder.key, nid, body, json.dumps(embedder.key))).rowcount:
+                continue
+            conn.execute("DELETE FROM embed_queue WHERE note_id=?", (nid,))
+            ids.append(nid)
+            kept.append(vec)
+            ts = max(ts, conn.execute("SELECT ts FROM notes WHERE id=?", (nid,)).fetchone()[0])
+    if ids:
+        try:
+            _vectors_written(ids, kept, ts)
+        except Exception:
+            # The vectors are committed and dequeued; rebuild the search structures from notes.emb so they
+            # are not lost
+            _reset_search(_search_model)
+            raise
+        _bump_generation()
+
+def embed_queue_status():
+    # Chunks still waiting for a vector, how many of them failed at least once and the latest error
+    with reader() as conn:
+        pending, retrying = conn.execute("SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0) FROM embed_queue").fetchone()
+        row = conn.execute(
+            "SELECT error FROM embed_queue WHERE error IS NOT NULL ORDER BY next_try DESC LIMIT 1").fetchone()
+    return {"pending": pending, "retrying": retrying, "last_error": row[0] if row else None}
+
+_embed_stats = {"hits": 0, "misses": 0}
+_embed_stats_lock = threading.Lock()
+
+def _embed_cached(texts, embedder=None):
+    # Embeds already-normalized texts, reusing vectors from embed_cache and storing the new ones.
+    model = (embedder or get_embedder()).key
+    hashes = [_content_hash(t) for t in texts]
+    unique = list(dict.fromkeys(hashes))
+    found = {}
+    with reader() as conn:
+        for i in range(0, len(unique), 500):
+            part = unique[i:i + 500]
+            found.update(
+                (digest, np.frombuffer(blob, dtype="float32"))
+                for digest, blob in conn.execute(
+                    f"SELECT hash, vec FROM embed_cache WHERE model=? AND hash IN ({','.join('?' * len(part))})",
+                    [model] + part))
+    hits = list(found)
+    missing = [h for h in unique if h not in found]
+    if missing:
+        text_of = dict(zip(hashes, texts))
+        embed = embedder.embed_many if embedder else embed_many
+        for digest, vec in zip(missing, embed([text_of[h] for h in missing])):
+            found[digest] = np.array(vec, dtype="float32")
+    now = time.time()
+    with writer() as conn:
+        conn.executemany("UPDATE embed_cache SET used=? WHERE model=? AND hash=?", [(now, model, h) for h in hits])
+        conn.executemany(
+            "INSERT OR REPLACE INTO embed_cache(model, hash, vec, used) VALUES(?,?,?,?)",
+            [(model, h, found[h].tobytes(), now) for h in missing if found[h].size])
+        if missing:
+            excess = conn.execute("SELECT COUNT(*) FROM embed_cache").fetchone()[0] - EMBED_CACHE_MAX
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM embed_cache WHERE rowid IN (SELECT rowid FROM embed_cache ORDER BY used LIMIT ?)",
+                    (excess,))
+    with _embed_stats_lock:
+        _embed_stats["hits"] += len(hashes) - len(missing)
+        _embed_stats["misses"] += len(missing)
+    return [found[h] for h in hashes]
+
+def embed_cache_stats():
+    with _embed_stats_lock:
+        stats = dict(_embed_stats)
+    with reader() as conn:
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM embed_cache").fetchone()[0]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+_answer_stats = {"hits": 0, "misses": 0}
+_answer_stats_lock = threading.Lock()
+
+def _answer_key(query: str, ctx):
+    # (unit query vector, context fingerprint): the sorted context note ids with their timestamps
+    ids = sorted({nid for nid, _ in ctx})
+    with reader() as conn:
+        stamps = conn.execute(
+            f"SELECT id, ts FROM notes WHERE id IN ({','.join('?' * len(ids))}) ORDER BY id", ids).fetchall()
+    vec = np.asarray(_embed_cached([_normalize(query)])[0], dtype="float32")
+    norm = np.linalg.norm(vec)
+    return (vec / norm if norm else vec), json.dumps(stamps)
+
+def cached_answer(query: str, ctx):
+    # The answer given to a near-identical question over the same, unedited context notes, or None
+    if not ctx:
+        return None
+    vec, context = _answer_key(query, ctx)
+    best, best_sim = None, ANSWER_CACHE_THRESHOLD
+    with reader() as conn:
+        for entry, blob, answer in conn.execute(
+                "SELECT id, vec, answer FROM answer_cache WHERE model=? AND context=?", (CHAT_MODEL, context)):
+            cached = np.frombuffer(blob, dtype="float32")
+            if cached.size == vec.size and float(cached @ vec) >= best_sim:
+                best, best_sim = (entry, answer), float(cached @ vec)
+    with _answer_stats_lock:
+        _answer_stats["hits" if best else "misses"] += 1
+    if best is None:
+        return None
+    with writer() as conn:
+        conn.execute("UPDATE answer_cache SET used=? WHERE id=?", (time.time(), best[0]))
+    return best[1]
+
+def store_answer(query: str, ctx, answer: str):
+    if not ctx or not answer:
+        return
+    vec, context = _answer_key(query, ctx)
+    with writer() as conn:
+        entry = conn.execute(
+            "INSERT INTO answer_cache(model, context, vec, answer, used) VALUES(?,?,?,?,?)",
+            (CHAT_MODEL, context, vec.tobytes(), answer, time.time())).lastrowid
+        conn.executemany("INSERT OR IGNORE INTO answer_cache_notes(note_id, entry) VALUES(?,?)",
+                         [(nid, entry) for nid, _ in json.loads(context)])
+        excess = conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0] - ANSWER_CACHE_MAX
+        if excess > 0:
+            conn.execute(
+                "DELETE FROM answer_cache WHERE id IN (SELECT id FROM answer_cache ORDER BY used LIMIT ?)",
+                (excess,))
+
+def answer_cache_stats():
+    with _answer_stats_lock:
+        stats = dict(_answer_stats)
+    with reader() as conn:
+        stats["entries"] = conn.execute("SELECT COUNT(*) FROM answer_cache").fetchone()[0]
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+    return stats
+
+# Every write bumps the generation, so cached results from before the write are never served.
+_generation = 0
+_generation_lock = threading.Lock()
+_data_version = None
+_search_behind = False  # the other app committed since the search structures last caught up
+
+def _bump_generation():
+    global _generation
+    with _generation_lock:
+        _generation += 1
+
+def _current_generation() -> int:
+    # PRAGMA data_version changes when a connection other than the one asked commits. Every write of this
+    # process goes through _writer, so asking _writer only counts the other app's commits; this process's
+    # own writes bump the generation themselves, and bookkeeping such as embed_cache.used doesn't.
+    global _data_version, _generation, _search_behind
+    with _write_lock:
+        version = _writer.execute("PRAGMA data_version").fetchone()[0]
+    with _generation_lock:
+        if _data_version is not None and _data_version != version:
+            _generation += 1
+            _search_behind = True
+        _data_version = version
+        return _generation
+
+class _ResultCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def get(self, key, generation: int):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] != generation or entry[1] < time.monotonic()):
+                del self._entries[key]
+                self._stats["stale"] += 1
+                entry = None
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[2]
+
+    def put(self, key, generation: int, value):
+        with self._lock:
+            self._entries[key] = (generation, time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+_topk_cache = _ResultCache(TOPK_CACHE_SIZE, TOPK_CACHE_TTL)
+_candidate_cache = _ResultCache(32, TOPK_CACHE_TTL)
+
+def topk_cache_stats():
+    return _topk_cache.stats()
 
-@lru_cache(maxsize=64)
 def topk(query: str, k: int = 4, tags: str = None, date_start: float = None, date_end: float = None):
+    tag_key = tuple(_split_tags(tags))
+    key = (" ".join(_normalize(query or "").split()), bool(query), k, tag_key, date_start, date_end)
+    generation = _current_generation()
+    rows = _topk_cache.get(key, generation)
+    if rows is None:
+        rows = _topk(query, k, tags, date_start, date_end)
+        _topk_cache.put(key, generation, rows)
+    return list(rows)
+
+def _topk(query: str, k: int = 4, tags: str = None, date_start: float = None, date_end: float = None):
     normalized_query = _normalize(query)
     fts_query = ' '.join([f"{word}*" for word in normalized_query.split()]) if query else ''
 
-    conditions = []
-    params = []
-    if tags:
-        tag_list = [tag.strip().lower() for tag in tags.split(',') if tag.strip()]
-        if tag_list:
-            conditions.append(" AND ".join("LOWER(tags) LIKE ?" for _ in tag_list))
-            params.extend([f"%{tag}%" for tag in tag_list])
-    if date_start is not None:
-        conditions.append("ts >= ?")
-        params.append(date_start)
-    if date_end is not None:
-        conditions.append("ts <= ?")
-        params.append(date_end)
+    conditions, params = _filters(tags=tags, date_start=date_start, date_end=date_end)
 
     emb_results = {}
-    if _index is not None and _index.get_current_count() > 0 and query:
+    current = bool(query) and _model_current()
+    if current:
+        _catch_up_search()
+    if current and _vector_count() > 0:
         try:
-            vec = _embed(query)
-            if vec.size == _DIM:
-                k_emb = min(k, _index.get_current_count())
-                labels, distances = _index.knn_query(vec, k=k_emb)
-                similarities = -distances[0]
+            vec = _prepare(_embed_cached([_normalize(query)])[0])
+            if (vec.size == _exact.dim) if _backend == "exact" else (_index_dim(vec.size) == _DIM):
+                labels, similarities = _vector_search(vec, k, conditions, params)
                 if len(similarities) > 0:
                     min_sim = np.min(similarities)
                     max_sim = np.max(similarities)
@@ -178,7 +1473,7 @@ def topk(query: str, k: int = 4, tags: str = None, date_start: float = None, dat
                         sim_emb_norm = (similarities - min_sim) / (max_sim - min_sim)
                     else:
                         sim_emb_norm = np.ones_like(similarities)
-                    emb_results = {int(label): score for label, score in zip(labels[0], sim_emb_norm)}
+                    emb_results = {int(label): score for label, score in zip(labels, sim_emb_norm)}
         except RuntimeError:
             pass
 
@@ -195,7 +1490,8 @@ def topk(query: str, k: int = 4, tags: str = None, date_start: float = None, dat
             {where_clause}
             ORDER BY rank LIMIT ?
         """
-        fts_rows = get_conn().execute(query, fts_params + [k]).fetchall()
+        with reader() as conn:
+            fts_rows = conn.execute(query, fts_params + [k]).fetchall()
         if fts_rows:
             rowids, ranks = zip(*fts_rows)
             similarities = -np.array(ranks)
@@ -210,11 +1506,12 @@ def topk(query: str, k: int = 4, tags: str = None, date_start: float = None, dat
     all_ids = set(emb_results.keys()).union(set(fts_results.keys()))
     if not query and not all_ids:
         where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
-        rows = get_conn().execute(
-            f"SELECT id, body FROM notes{where_clause}",
-            params
-        ).fetchall()
-        return rows[:k]
+        with reader() as conn:
+            rows = conn.execute(
+                f"SELECT id, body FROM notes{where_clause} LIMIT ?",
+                params + [k]
+            ).fetchall()
+        return rows
 
     if not all_ids:
         return []
@@ -227,72 +1524,492 @@ def topk(query: str, k: int = 4, tags: str = None, date_start: float = None, dat
 
     sorted_ids = sorted(all_ids, key=lambda x: scores[x], reverse=True)
     placeholders = ','.join('?' * len(sorted_ids))
-    rows = get_conn().execute(
-        f"SELECT id, body FROM notes WHERE id IN ({placeholders})",
-        list(sorted_ids)
-    ).fetchall()
+    with reader() as conn:
+        rows = conn.execute(
+            f"SELECT id, body FROM notes WHERE id IN ({placeholders})",
+            list(sorted_ids)
+        ).fetchall()
 
     id_to_row = {row[0]: row for row in rows}
     sorted_rows = [id_to_row[nid] for nid in sorted_ids if nid in id_to_row]
     return sorted_rows[:k]
 
-def filter_notes(text: str = None, tags: str = None, date_start: float = None, date_end: float = None):
+def _model_current() -> bool:
+    # Whether query vectors from this process's provider are comparable with the stored ones. Drops the
+    # search structures once a re-embedding cut over, in this app or the other one.
+    global _search_model
+    active = _get_setting("emb_model")
+    if active != _search_model:
+        _reset_search(active)
+    return get_embedder().key == active
+
+def _catch_up_search():
+    # Adds the vectors the other app committed (notes it saved, chunks its queue embedded) to the loaded
+    # index or matrix, which otherwise only catch up on load and flush
+    global _search_behind, _index_hwm, _index_max_id
+    with _generation_lock:
+        behind, _search_behind = _search_behind, False
+    if not behind:
+        return
+    if _backend == "exact":
+        _exact.catch_up()
+        return
+    with _index_lock:
+        if _index is not None:
+            _index_hwm, _index_max_id = _replay(_index, _DIM, _index_hwm, _index_max_id)
+            _index_max_id = _watermark(_index_max_id)  # queued chunks are replayed once embedded
+
+def _reset_search(model: str):
+    # Forgets the loaded index and matrix; they are rebuilt from notes.emb, and saved snapshots of another
+    # model are not reused
+    global _index, _DIM, _index_hwm, _index_max_id, _index_dirty, _index_deleted, _backend, _search_model
+    with _index_lock:
+        _index, _DIM, _index_hwm, _index_max_id, _index_dirty, _index_deleted = None, 0, 0.0, 0, 0, set()
+        _exact.reset()
+        _backend, _search_model = None, model
+    _bump_generation()
+
+def _vector_count() -> int:
+    if _search_backend() == "exact":
+        return _exact.count()
+    _ensure_index()
+    return _index.get_current_count() - len(_index_deleted) if _index is not None else 0
+
+def _vector_search(vec, k: int, conditions, params):
+    # Returns (labels, similarities) of the k nearest notes that also satisfy the SQL filters.
+    if _backend == "exact":
+        if not conditions:
+            return _exact.search(vec, k)
+        ids, _, _ = _candidates(conditions, params, vec.size, vectors=False)
+        return _exact.search(vec, k, ids)
+    if not conditions:
+        return _ann_search(vec, k, None)
+    ids, id_set, matrix = _candidates(conditions, params, vec.size)
+    if len(ids) == 0:
+        return ids, np.empty(0, dtype="float32")
+    if matrix is not None:
+        # Few enough candidates to score them all exactly
+        similarities = matrix @ vec
+        top = np.argpartition(-similarities, min(k, len(ids)) - 1)[:k]
+        return ids[top], similarities[top]
+    return _ann_search(vec, min(k, len(ids)), id_set)
+
+def _ann_search(vec, k: int, id_set):
+    # When the index only holds a prefix of each vector, over-fetches and re-scores the candidates exactly
+    coarse = _index_dim(vec.size) < vec.size
+    oversample = RESCORE_OVERSAMPLE if coarse else 1
+    with _search_gate.search():
+        idx = _index
+        live = idx.get_current_count() - len(_index_deleted)
+        n = min(k * oversample, live if id_set is None else min(live, len(id_set)))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype="float32")
+        if id_set is None:
+            labels, distances = idx.knn_query(_coarse(vec), k=n)
+        else:
+            labels, distances = idx.knn_query(_coarse(vec), k=n, num_threads=1, filter=lambda label: label in id_set)
+    if coarse:
+        return _rescore(vec, labels[0], k)
+    return labels[0], -distances[0]
+
+def _rescore(vec, labels, k: int):
+    # Exact similarities of the ANN candidates against their stored vectors, best k first
+    labels = np.asarray(labels, dtype=np.int64)
+    placeholders = ",".join("?" * len(labels))
+    with reader() as conn:
+        blobs = dict(conn.execute(f"SELECT id, emb FROM notes WHERE id IN ({placeholders})", labels.tolist()))
+    found = [(nid, _decode(blobs[nid])) for nid in labels.tolist() if blobs.get(nid) is not None]
+    found = [(nid, v) for nid, v in found if v.size == vec.size]
+    if not found:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype="float32")
+    ids = np.array([nid for nid, _ in found], dtype=np.int64)
+    similarities = np.vstack([v for _, v in found]) @ vec
+    top = np.argsort(-similarities)[:k]
+    return ids[top], similarities[top]
+
+def _candidates(conditions, params, dim: int, vectors: bool = True):
+    # Resolves the filters to matching note ids once per storage generation. Sets of up to
+    # EXACT_SEARCH_MAX ids also keep their vectors for exact scoring; larger ones become an ANN filter.
+    key = (tuple(conditions), tuple(params), dim, vectors)
+    generation = _current_generation()
+    hit = _candidate_cache.get(key, generation)
+    if hit is not None:
+        return hit
+    where_clause = " AND ".join(["emb IS NOT NULL"] + conditions)
+    rows = None
+    with reader() as conn:
+        ids = np.fromiter((nid for (nid,) in conn.execute(f"SELECT id FROM notes WHERE {where_clause}", params)),
+                          dtype=np.int64)
+        if vectors and len(ids) <= EXACT_SEARCH_MAX:
+            rows = [(nid, blob) for nid, blob in conn.execute(f"SELECT id, emb FROM notes WHERE {where_clause}", params)
+                    if _blob_dim(len(blob)) == dim]
+    if rows is not None:
+        ids = np.array([nid for nid, _ in rows], dtype=np.int64)
+        matrix = (np.vstack([_decode(blob) for _, blob in rows]) if rows
+                  else np.empty((0, dim), dtype="float32"))
+        value = (ids, None, matrix)
+    else:
+        value = (ids, set(ids.tolist()), None)
+    _candidate_cache.put(key, generation, value)
+    return value
+
+def _filters(text: str = None, tags: str = None, date_start: float = None, date_end: float = None):
     conditions = []
     params = []
-    if text:
+    if text and len(text) >= 3:
+        # The trigram index answers LIKE '%text%' case-insensitively without scanning every body
+        conditions.append("notes.id IN (SELECT rowid FROM notes_trigram WHERE body LIKE ?)")
+        params.append(f"%{text}%")
+    elif text:
         conditions.append("LOWER(body) LIKE ?")
         params.append(f"%{text.lower()}%")
-    if tags:
-        tag_list = [tag.strip().lower() for tag in tags.split(',') if tag.strip()]
-        if tag_list:
-            conditions.append(" AND ".join("LOWER(tags) LIKE ?" for _ in tag_list))
-            params.extend([f"%{tag}%" for tag in tag_list])
+    for tag in _split_tags(tags):
+        conditions.append("notes.id IN (SELECT note_id FROM note_tags WHERE tag = ?)")
+        params.append(tag)
     if date_start is not None:
         conditions.append("ts >= ?")
         params.append(date_start)
     if date_end is not None:
         conditions.append("ts <= ?")
         params.append(date_end)
+    return conditions, params
+
+# Executor threads borrow pooled read connections through reader()
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="storage")
+
+async def atopk(query: str, k: int = 4, tags: str = None, date_start: float = None, date_end: float = None):
+    return await asyncio.get_running_loop().run_in_executor(
+        _executor, topk, query, k, tags, date_start, date_end)
+
+def encode_cursor(row) -> str:
+    # Opaque keyset cursor pointing just past a (id, parent_id, ts, ...) listing row
+    return base64.urlsafe_b64encode(json.dumps([row[2], row[0]]).encode()).decode()
+
+def decode_cursor(cursor: str):
+    try:
+        ts, nid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(ts), int(nid)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor")
+
+def _list_notes(conditions, params, limit: int = None, cursor: str = None):
+    # Newest first, paged by (ts, id) so each page is an index range scan however deep it is
+    conditions, params = list(conditions), list(params)
+    if cursor:
+        conditions.append("(ts, id) < (?, ?)")
+        params.extend(decode_cursor(cursor))
     where_clause = " WHERE " + " AND ".join(conditions) if conditions else ""
-    return get_conn().execute(
-        f"SELECT id, parent_id, ts, body, tags, is_favorite FROM notes{where_clause} ORDER BY ts DESC",
-        params
-    ).fetchall()
+    sql = f"SELECT id, parent_id, ts, body, tags, is_favorite FROM notes{where_clause} ORDER BY ts DESC, id DESC"
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(limit)
+    with reader() as conn:
+        return conn.execute(sql, params).fetchall()
+
+def filter_notes(text: str = None, tags: str = None, date_start: float = None, date_end: float = None,
+                 limit: int = None, cursor: str = None):
+    conditions, params = _filters(text, tags, date_start, date_end)
+    return _list_notes(conditions, params, limit, cursor)
+
+def _content_hash(body: str) -> str:
+    return hashlib.sha1(body.encode("utf-8")).hexdigest()
 
 def get_recent_notes(limit: int = 10):
-    return get_conn().execute(
-        "SELECT id, parent_id, ts, body, tags, is_favorite FROM notes ORDER BY ts DESC LIMIT ?",
-        (limit,)
-    ).fetchall()
+    with reader() as conn:
+        return conn.execute(
+            "SELECT id, parent_id, ts, body, tags, is_favorite FROM notes ORDER BY ts DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
 
-def get_favorite_notes():
-    return get_conn().execute(
-        "SELECT id, parent_id, ts, body, tags, is_favorite FROM notes WHERE is_favorite = 1 ORDER BY ts DESC"
-    ).fetchall()
+def get_favorite_notes(limit: int = None, cursor: str = None):
+    return _list_notes(["is_favorite = 1"], [], limit, cursor)
 
 def toggle_favorite(nid: int) -> bool:
-    current = get_conn().execute("SELECT is_favorite FROM notes WHERE id=?", (nid,)).fetchone()
-    if current is None:
-        return False
-    new_value = 0 if current[0] else 1
-    get_conn().execute("UPDATE notes SET is_favorite=? WHERE id=?", (new_value, nid))
-    get_conn().commit()
+    with writer() as conn:
+        current = conn.execute("SELECT is_favorite FROM notes WHERE id=?", (nid,)).fetchone()
+        if current is None:
+            return False
+        new_value = 0 if current[0] else 1
+        conn.execute("UPDATE notes SET is_favorite=? WHERE id=?", (new_value, nid))
     return bool(new_value)
 
-def all_notes():
-    return get_conn().execute(
-        "SELECT id, parent_id, ts, body, tags, is_favorite FROM notes ORDER BY ts DESC"
-    ).fetchall()
+def tag_counts():
+    # Number of notes per tag, most used first; the chunks of one note count once
+    with reader() as conn:
+        return conn.execute(
+            "SELECT tag, COUNT(DISTINCT COALESCE(notes.parent_id, notes.id)) AS n FROM note_tags "
+            "JOIN notes ON notes.id = note_tags.note_id GROUP BY tag ORDER BY n DESC, tag"
+        ).fetchall()
+
+def all_notes(limit: int = None, cursor: str = None):
+    return _list_notes([], [], limit, cursor)
 
 def delete(nid: int):
-    if _index:
-        _index.mark_deleted(nid)
-    get_conn().execute("DELETE FROM notes WHERE id=?", (nid,))
-    get_conn().commit()
+    with writer() as conn:
+        conn.execute("DELETE FROM notes WHERE id=?", (nid,))
+    _vectors_deleted([nid])
+    _bump_generation()
+    _fts_written()
 
 def export_notes():
-    rows = get_conn().execute("SELECT id, parent_id, ts, body, tags, is_favorite FROM notes").fetchall()
+    with reader() as conn:
+        rows = conn.execute(
+            "SELECT id, parent_id, ts, body, tags, is_favorite, chunk_start, chunk_end FROM notes").fetchall()
     return [
-        {"id": nid, "parent_id": pid, "timestamp": ts, "body": body, "tags": tags, "is_favorite": bool(is_fav)}
-        for nid, pid, ts, body, tags, is_fav in rows
-    ]
\ No newline at end of file
+        {"id": nid, "parent_id": pid, "timestamp": ts, "body": body, "tags": tags, "is_favorite": bool(is_fav),
+         "chunk_start": start, "chunk_end": end}
+        for nid, pid, ts, body, tags, is_fav, start, end in rows
+    ]
+
+IMPORT_BATCH = 256  # chunks per pipeline batch
+IMPORT_DEPTH = 4  # batches buffered between stages
+
+def _stage(fn, inbox, outbox, stop, errors):
+    # Runs fn over every batch from inbox, passing results on until the None sentinel arrives.
+    # After a failure anywhere, batches already handed downstream are still committed.
+    def run():
+        try:
+            while True:
+                item = inbox.get()
+                if item is None:
+                    break
+                result = fn(item)
+                if outbox is not None:
+                    _put(outbox, result, stop)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            while inbox.get() is not None:
+                pass
+        finally:
+            if outbox is not None:
+                outbox.put(None)
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _check_import_model(active: str, model: str):
+    if active is not None and active != model:
+        raise ValueError(f"The vault's vectors come from {active}, not {model}. Import with the vault's provider, "
+                         f"or re-embed the vault with {model} first.")
+
+def import_notes(records, source: str = None, batch_size: int = IMPORT_BATCH, progress=None):
+    """Bulk-load notes from an iterable of dicts shaped like export_notes() rows.
+
+    Only "body" is required; "timestamp", "tags", "is_favorite", "id", "parent_id" and
+    "chunk_start" are kept when present. Chunking, embedding, inserting and indexing run as
+    concurrent stages over bounded queues. With a `source` name, committed progress is
+    checkpointed so a rerun resumes after the last committed batch. Raises ValueError when the
+    configured provider is not the one the vault's vectors come from. Returns a throughput report.
+    """
+    started = time.time()
+    done = 0
+    if source is not None:
+        with reader() as conn:
+            row = conn.execute("SELECT done FROM imports WHERE source=?", (source,)).fetchone()
+        done = row[0] if row else 0
+    stats = {"skipped": done, "records": 0, "chunks": 0}
+    id_map = {}
+    stop = threading.Event()
+    errors = []
+    to_embed = queue.Queue(IMPORT_DEPTH)
+    to_write = queue.Queue(IMPORT_DEPTH)
+    to_index = queue.Queue(IMPORT_DEPTH)
+    embedder = get_embedder()
+    model = embedder.key
+    _check_import_model(_get_setting("emb_model"), model)
+
+    def embed_batch(batch):
+        texts = [_normalize(rec["body"][start:end]) for _, rec, chunks in batch for start, end in chunks]
+        vecs = iter([_prepare(v) for v in _embed_cached(texts, embedder)])
+        return [(pos, rec, [(span, next(vecs)) for span in chunks])
+                for pos, rec, chunks in batch]
+
+    def write_batch(batch):
+        ids, vecs, latest = [], [], 0.0
+        with writer() as conn:
+            # A re-embedding may have cut over to another model since the import started
+            row = conn.execute("SELECT value FROM settings WHERE key='emb_model'").fetchone()
+            _check_import_model(row and json.loads(row[0]), model)
+            for pos, rec, chunks in batch:
+                ts = float(rec.get("timestamp") or time.time())
+                latest = max(latest, ts)
+                tags = rec.get("tags") or ""
+                if isinstance(tags, list):
+                    tags = ",".join(tags)
+                parent = id_map.get(rec.get("parent_id"))
+                if parent is None and rec.get("parent_id") is not None and source is not None:
+                    row = conn.execute("SELECT note_id FROM import_ids WHERE source=? AND record_id=?",
+                                       (source, rec["parent_id"])).fetchone()
+                    if row:
+                        parent = id_map[rec["parent_id"]] = row[0]
+                # Offsets are relative to the whole note; an exported chunk knows where it started
+                base = rec.get("chunk_start")
+                if base is None and rec.get("parent_id") is None:
+                    base = 0
+                first = None
+                for (start, end), vec in chunks:
+                    if vec.size == 0:
+                        continue
+                    cur = conn.execute(
+                        "INSERT INTO notes(parent_id, body, ts, emb, emb_model, tags, is_favorite, chunk_start, "
+                        "chunk_end) VALUES(?,?,?,?,?,?,?,?,?)",
+                        (parent, rec["body"][start:end], ts, _encode(vec), model, tags,
+                         int(bool(rec.get("is_favorite"))),
+                         None if base is None else base + start, None if base is None else base + end))
+                    if first is None:
+                        first = cur.lastrowid
+                    if parent is None:
+                        parent = first  # the later chunks of a top-level note hang off its first one
+                    ids.append(cur.lastrowid)
+                    vecs.append(vec)
+                    _set_tags(conn, [cur.lastrowid], tags)
+                if first is not None and rec.get("id") is not None:
+                    id_map[rec["id"]] = parent
+                    if source is not None:
+                        conn.execute("INSERT OR REPLACE INTO import_ids(source, record_id, note_id) VALUES(?,?,?)",
+                                     (source, rec["id"], parent))
+            if source is not None:
+                conn.execute(
+                    "INSERT INTO imports(source, done, ts) VALUES(?,?,?) "
+                    "ON CONFLICT(source) DO UPDATE SET done=excluded.done, ts=excluded.ts",
+                    (source, batch[-1][0] + 1, time.time()))
+        _bump_generation()
+        stats["records"] += len(batch)
+        stats["chunks"] += len(ids)
+        if progress:
+            progress(_import_report(stats, started))
+        return ids, vecs, latest
+
+    def index_batch(written):
+        ids, vecs, latest = written
+        if not ids:
+            return
+        _vectors_written(ids, vecs, latest)
+
+    threads = [
+        _stage(embed_batch, to_embed, to_write, stop, errors),
+        _stage(write_batch, to_write, to_index, stop, errors),
+        _stage(index_batch, to_index, None, stop, errors),
+    ]
+    try:
+        batch, size = [], 0
+        for pos, rec in enumerate(records):
+            if stop.is_set():
+                break
+            if pos < done or not (rec.get("body") or "").strip():
+                continue
+            chunks = list(_chunk(rec["body"]))
+            batch.append((pos, rec, chunks))
+            size += len(chunks)
+            if size >= batch_size:
+                _put(to_embed, batch, stop)
+                batch, size = [], 0
+        if batch:
+            _put(to_embed, batch, stop)
+    finally:
+        to_embed.put(None)
+        for t in threads:
+            t.join()
+    flush_index()
+    if stats["chunks"]:
+        fts_optimize()
+    if errors:
+        raise errors[0]
+    return _import_report(stats, started)
+
+def _import_report(stats, started):
+    elapsed = max(time.time() - started, 1e-9)
+    return dict(stats, seconds=round(elapsed, 2),
+                records_per_s=round(stats["records"] / elapsed, 1),
+                chunks_per_s=round(stats["chunks"] / elapsed, 1))
+
+REEMBED_BATCH = 64  # chunks per re-embedding request and checkpoint
+
+def reembed(embedder=None, batch_size: int = REEMBED_BATCH, progress=None):
+    """Re-embeds every chunk with `embedder` (default: the configured provider) and switches search to it.
+
+    New vectors go to notes.emb_next while searches keep using notes.emb. The walk is checkpointed per
+    batch in settings, so a rerun for the same model resumes where it stopped. Chunks saved or edited
+    behind the walk are caught up, then one transaction moves every emb_next into emb. Returns a
+    throughput report.
+    """
+    target = embedder or get_embedder()
+    started = time.time()
+    fmt = {"codec": VECTOR_CODEC, "dims": VECTOR_DIMS}
+    job = _get_setting("reembed")
+    if job is None or job["model"] != target.key or job["format"] != fmt:
+        job = {"model": target.key, "format": fmt, "after": 0, "done": 0, "started": started}
+        with writer() as conn:
+            conn.execute("UPDATE notes SET emb_next=NULL WHERE emb_next IS NOT NULL")
+            _set_setting(conn, "reembed", job)
+    stats = {"skipped": job["done"], "chunks": 0}
+
+    def embed_rows(rows):
+        vecs = [_prepare(v) for v in _embed_cached([_normalize(body) for _, body in rows], target)]
+        for (nid, _), v in zip(rows, vecs):
+            if v.size == 0:
+                raise RuntimeError(f"{target.key} returned no vector for note {nid}")
+        stats["chunks"] += len(rows)
+        # A chunk edited meanwhile keeps emb_next NULL and is caught up below
+        return [(_encode(v), nid, body) for (nid, body), v in zip(rows, vecs)]
+
+    while True:
+        with reader() as conn:
+            rows = conn.execute("SELECT id, body FROM notes WHERE id > ? ORDER BY id LIMIT ?",
+                                (job["after"], batch_size)).fetchall()
+        if not rows:
+            break
+        updates = embed_rows(rows)
+        job["after"], job["done"] = rows[-1][0], job["done"] + len(rows)
+        with writer() as conn:
+            conn.executemany("UPDATE notes SET emb_next=? WHERE id=? AND body=?", updates)
+            _set_setting(conn, "reembed", job)
+        if progress:
+            progress(_reembed_report(stats, started))
+    while True:
+        with writer() as conn:
+            rows = conn.execute("SELECT id, body FROM notes WHERE emb_next IS NULL ORDER BY id LIMIT ?",
+                                (batch_size,)).fetchall()
+            if not rows:
+                conn.execute("UPDATE notes SET emb=emb_next, emb_model=?, emb_next=NULL", (target.key,))
+                conn.execute("DELETE FROM embed_queue")
+                conn.execute("DELETE FROM answer_cache")
+                conn.execute("DELETE FROM settings WHERE key='reembed'")
+                _set_setting(conn, "emb_model", target.key)
+                break
+        updates = embed_rows(rows)
+        with writer() as conn:
+            conn.executemany("UPDATE notes SET emb_next=? WHERE id=? AND body=?", updates)
+        if progress:
+            progress(_reembed_report(stats, started))
+    use_embedder(target)
+    _reset_search(target.key)
+    return _reembed_report(stats, started)
+
+def _reembed_report(stats, started):
+    elapsed = max(time.time() - started, 1e-9)
+    return dict(stats, seconds=round(elapsed, 2), chunks_per_s=round(stats["chunks"] / elapsed, 1))
+
+def reembed_status():
+    # The model search uses, chunks whose vector came from another model or none yet, and the progress
+    # of an unfinished re-embedding
+    model = _get_setting("emb_model")
+    with reader() as conn:
+        total, stale = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(emb_model IS NOT ?), 0) FROM notes", (model,)).fetchone()
+    job = _get_setting("reembed")
+    return {"model": model, "chunks": total, "stale": stale,
+            "job": job and {"model": job["model"], "done": job["done"], "total": total, "started": job["started"]}}
+
+# Chunks left in the queue by an earlier run, or saved by the other app
+if _writer.execute("SELECT EXISTS(SELECT 1 FROM embed_queue)").fetchone()[0]:
+    _wake_embedder()
@@ -1,12 +1,12 @@
 import sys
 import os
+import signal
 import logging
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from datetime import datetime
 import shutil
 import json
-from sentence_transformers import SentenceTransformer, util
 
 # Configure logging
 logging.basicConfig(
@@ -41,9 +41,13 @@ logger.debug(f"sys.path: {sys.path}")
 try:
     from storage import (
         add, get_note, update_note, delete, filter_notes, topk,
-        get_recent_notes, get_favorite_notes, toggle_favorite, export_notes, DB
+        get_recent_notes, get_favorite_notes, toggle_favorite, export_notes, DB,
+        tag_counts, encode_cursor, pack_context,
+        cached_answer, store_answer, answer_cache_stats, embed_cache_stats, topk_cache_stats,
+        embed_queue_status, reembed_status
     )
-    from llm import chat
+    from llm import chat, chat_stream
+    from embedding import get_embedder
     logger.info("Successfully imported storage and llm modules")
 except ImportError as e:
     logger.error(f"Failed to import modules: {e}")
@@ -52,9 +56,9 @@ except ImportError as e:
 app = Flask(__name__)
 CORS(app, origins="*")  # Temporarily allow all origins for debugging
 
-# Load the NLP model for AI-Powered Search
-model = SentenceTransformer('all-MiniLM-L6-v2')
-logger.info("NLP model loaded: all-MiniLM-L6-v2")
+# Same embedding provider as storage (SECOND_BRAIN_EMBEDDER), so both apps search one vector space
+embedder = get_embedder()
+logger.info(f"Embedding provider: {embedder.key}")
 
 # Helper to format notes for JSON response
 def format_note(note):
@@ -136,6 +140,22 @@ def delete_note(nid):
         logger.error(f"Error deleting note {nid}: {e}")
         return jsonify({"error": str(e)}), 500
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+def page_limit(value):
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return PAGE_SIZE
+
+def page(notes, limit):
+    # "next" is the keyset cursor for the following page, or None when this one is the last.
+    return {
+        "notes": [format_note(note) for note in notes],
+        "next": encode_cursor(notes[-1]) if len(notes) == limit else None,
+    }
+
 @app.route('/filter_notes', methods=['POST'])
 def filter_notes_route():
     logger.info("Received /filter_notes request")
@@ -151,10 +171,15 @@ def filter_notes_route():
     if date_end:
         date_end = datetime.strptime(date_end, "%Y-%m-%d").timestamp() + 86399
     
+    limit = page_limit(data.get('limit'))
+    cursor = data.get('cursor')
     try:
-        notes = filter_notes(text, tags, date_start, date_end)
+        notes = filter_notes(text, tags, date_start, date_end, limit=limit, cursor=cursor)
         logger.info(f"Retrieved {len(notes)} notes")
-        return jsonify([format_note(note) for note in notes]), 200
+        return jsonify(page(notes, limit)), 200
+    except ValueError as e:
+        logger.error(f"Bad /filter_notes request: {e}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error filtering notes: {e}")
         return jsonify({"error": str(e)}), 500
@@ -173,14 +198,30 @@ def recent_notes_route():
 @app.route('/favorite_notes', methods=['GET'])
 def favorite_notes_route():
     logger.info("Received /favorite_notes request")
+    limit = page_limit(request.args.get('limit'))
+    cursor = request.args.get('cursor')
     try:
-        notes = get_favorite_notes()
+        notes = get_favorite_notes(limit=limit, cursor=cursor)
         logger.info(f"Retrieved {len(notes)} favorite notes")
-        return jsonify([format_note(note) for note in notes]), 200
+        return jsonify(page(notes, limit)), 200
+    except ValueError as e:
+        logger.error(f"Bad /favorite_notes request: {e}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error retrieving favorite notes: {e}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/tag_counts', methods=['GET'])
+def tag_counts_route():
+    logger.info("Received /tag_counts request")
+    try:
+        counts = tag_counts()
+        logger.info(f"Retrieved counts for {len(counts)} tags")
+        return jsonify([{"tag": tag, "count": count} for tag, count in counts]), 200
+    except Exception as e:
+        logger.error(f"Error retrieving tag counts: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/toggle_favorite/<int:nid>', methods=['POST'])
 def toggle_favorite_route(nid):
     logger.info(f"Received /toggle_favorite/{nid} request")
@@ -192,62 +233,58 @@ def toggle_favorite_route(nid):
         logger.error(f"Error toggling favorite for note {nid}: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Parse the ask request, retrieve the best-matching notes and build the LLM prompt
+def prepare_ask(data):
+    if data is None:
+        raise ValueError("No JSON data in request or invalid Content-Type")
+    logger.debug(f"Request data: {data}")
+    
+    query = data.get('query', '')
+    tags = ','.join(data.get('tags', []))
+    date_start = data.get('date_start', None)
+    if date_start:
+        date_start = datetime.strptime(date_start, "%Y-%m-%d").timestamp()
+    date_end = data.get('date_end', None)
+    if date_end:
+        date_end = datetime.strptime(date_end, "%Y-%m-%d").timestamp() + 86399
+    
+    if not query:
+        raise ValueError("Query is required")
+    
+    # Same hybrid search as the GUI, over the vectors the embed queue already stored in notes.emb
+    ctx = topk(query, k=6, tags=tags, date_start=date_start, date_end=date_end)
+    
+    if not ctx:
+        return [], None
+    
+    # Merged per note and trimmed to the passages closest to the query, within the prompt token budget
+    ctx_block = "\n".join(f"[[{nid}]] {b}" for nid, b in pack_context(query, ctx))
+    prompt = (
+        "Here are my notes:\n" + ctx_block + "\n\n"
+        "Using ONLY these notes, answer the question below. "
+        "If the answer isn’t in the notes, say 'I don’t know.' "
+        "Cite notes with [[nid]].\n\n"
+        f"Question: {query}\nAnswer:"
+    )
+    logger.debug(f"Generated prompt: {prompt}")
+    return ctx, prompt
+
 @app.route('/ask', methods=['POST'])
 def ask_route():
     logger.info("Received /ask request")
     try:
         data = request.get_json()
-        if data is None:
-            raise ValueError("No JSON data in request or invalid Content-Type")
-        logger.debug(f"Request data: {data}")
-        
-        query = data.get('query', '')
-        tags = ','.join(data.get('tags', []))
-        date_start = data.get('date_start', None)
-        if date_start:
-            date_start = datetime.strptime(date_start, "%Y-%m-%d").timestamp()
-        date_end = data.get('date_end', None)
-        if date_end:
-            date_end = datetime.strptime(date_end, "%Y-%m-%d").timestamp() + 86399
-        
-        if not query:
-            logger.warning("Query is required but not provided")
-            return jsonify({"error": "Query is required"}), 400
-        
-        # Generate query embedding
-        query_embedding = model.encode(query, convert_to_tensor=True)
-        
-        # Retrieve notes with filters (text=None to get all notes within filters)
-        notes = filter_notes(text=None, tags=tags, date_start=date_start, date_end=date_end)
-        
-        if not notes:
+        ctx, prompt = prepare_ask(data)
+        if not ctx:
             return jsonify({"answer": "No notes available", "context": []}), 200
         
-        # Generate embeddings for note bodies
-        note_embeddings = model.encode([note[3] for note in notes], convert_to_tensor=True)
-        
-        # Compute cosine similarities
-        similarities = util.pytorch_cos_sim(query_embedding, note_embeddings)[0]
-        
-        # Get top-k indices
-        k = 6
-        top_k_indices = similarities.topk(k).indices
-        
-        # Get top-k notes
-        ctx = [(notes[i][0], notes[i][3]) for i in top_k_indices]
-        
-        ctx_block = "\n".join(f"[[{nid}]] {b}" for nid, b in ctx)
-        prompt = (
-            "Here are my notes:\n" + ctx_block + "\n\n"
-            "Using ONLY these notes, answer the question below. "
-            "If the answer isn’t in the notes, say 'I don’t know.' "
-            "Cite notes with [[nid]].\n\n"
-            f"Question: {query}\nAnswer:"
-        )
-        logger.debug(f"Generated prompt: {prompt}")
-        
-        answer = chat(prompt)
-        logger.info("Generated answer from LLM")
+        answer = cached_answer(data['query'], ctx)
+        if answer is not None:
+            logger.info("Answered from the answer cache")
+        else:
+            answer = chat(prompt)
+            logger.info("Generated answer from LLM")
+            store_answer(data['query'], ctx, answer)
         
         response = {
             "answer": answer,
@@ -262,6 +299,83 @@ def ask_route():
         logger.error(f"Error processing ask request: {e}")
         return jsonify({"error": str(e)}), 500
 
+# Server-Sent Events: one "context" event, a "token" event per generated piece, then "done" or "error"
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream_route():
+    logger.info("Received /ask/stream request")
+    try:
+        data = request.get_json()
+        ctx, prompt = prepare_ask(data)
+        cached = cached_answer(data['query'], ctx)
+    except ValueError as e:
+        logger.error(f"Invalid request: {e}")
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error processing ask request: {e}")
+        return jsonify({"error": str(e)}), 500
+    
+    def generate():
+        yield sse("context", [{"id": nid, "body": body} for nid, body in ctx])
+        if not ctx:
+            yield sse("token", "No notes available")
+            yield sse("done", {})
+            return
+        if cached is not None:
+            logger.info("Answered from the answer cache")
+            yield sse("token", cached)
+            yield sse("done", {"cached": True})
+            return
+        try:
+            answer = ""
+            for piece in chat_stream(prompt):
+                answer += piece
+                yield sse("token", piece)
+            logger.info("Streamed answer from LLM")
+            store_answer(data['query'], ctx, answer)
+            yield sse("done", {})
+        except Exception as e:
+            logger.error(f"Error streaming answer: {e}")
+            yield sse("error", {"error": str(e)})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats_route():
+    logger.info("Received /cache_stats request")
+    try:
+        return jsonify({
+            "answers": answer_cache_stats(),
+            "embeddings": embed_cache_stats(),
+            "search": topk_cache_stats()
+        }), 200
+    except Exception as e:
+        logger.error(f"Error reading cache stats: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Notes saved but not yet embedded; the UI can show this while they are indexed in the background
+@app.route('/embed_queue', methods=['GET'])
+def embed_queue_route():
+    logger.info("Received /embed_queue request")
+    try:
+        return jsonify(embed_queue_status()), 200
+    except Exception as e:
+        logger.error(f"Error reading the embedding queue: {e}")
+        return jsonify({"error": str(e)}), 500
+
+# Which embedding model search uses and how far a re-embedding (brain/reembed.py) has got
+@app.route('/reembed_status', methods=['GET'])
+def reembed_status_route():
+    logger.info("Received /reembed_status request")
+    try:
+        return jsonify(reembed_status()), 200
+    except Exception as e:
+        logger.error(f"Error reading re-embedding status: {e}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/export_notes', methods=['POST'])
 def export_notes_route():
     logger.info("Received /export_notes request")
@@ -294,6 +408,8 @@ def export_notes_route():
         return jsonify({"error": str(e)}), 500
 
 if __name__ == "__main__":
+    # Electron stops the backend with SIGTERM; exit normally so the vector index snapshot is flushed.
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     logger.info("Starting Flask server")
     app.run(host='127.0.0.1', port=5001, debug=True)
     logger.info("Flask server stopped")
\ No newline at end of file
@@ -0,0 +1,38 @@
+# Storage opens ~/.second-brain at import, so each test runs its script in a subprocess with a scratch HOME.
+# The script starts with a deterministic fake embedder installed through the provider registry.
+import pathlib
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+BRAIN = pathlib.Path(__file__).resolve().parent.parent / "brain"
+
+PRELUDE = """
+import hashlib
+import numpy as np
+import embedding
+
+class FakeEmbedder:
+    key = "test:fake"
+
+    def embed_many(self, texts):
+        out = []
+        for text in texts:
+            v = np.frombuffer(hashlib.sha256(text.encode()).digest(), dtype=np.uint8)[:16].astype("float32")
+            out.append(v / np.linalg.norm(v))
+        return out
+
+embedding.use_embedder(FakeEmbedder())
+"""
+
+@pytest.fixture
+def run_brain(tmp_path):
+    def run(script, **env):
+        out = subprocess.run([sys.executable, "-c", PRELUDE + textwrap.dedent(script)], cwd=BRAIN,
+                             capture_output=True, text=True, timeout=120,
+                             env={"HOME": str(tmp_path), "PATH": "/usr/bin:/bin", "PYTHONPATH": str(BRAIN), **env})
+        assert out.returncode == 0, out.stderr
+        return out.stdout
+    return run
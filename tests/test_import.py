@@ -0,0 +1,33 @@
+# Bulk imports (import_notes)
+
+def test_child_chunks_keep_the_real_parent(run_brain):
+    run_brain("""
+import storage
+long_body = " ".join(f"Sentence {i} about gardens." for i in range(400))
+storage.import_notes([{"id": 1, "body": "Top note about gardens."},
+                      {"id": 2, "parent_id": 1, "body": long_body, "chunk_start": 30}])
+with storage.reader() as conn:
+    rows = conn.execute("SELECT id, parent_id FROM notes ORDER BY id").fetchall()
+assert len(rows) > 2, rows
+assert rows[0][1] is None and all(parent == rows[0][0] for _, parent in rows[1:]), rows
+assert long_body in storage.note_text(rows[-1][0])
+""")
+
+def test_import_refuses_another_provider(run_brain):
+    run_brain("""
+import storage
+storage.import_notes([{"body": "First note."}])
+
+class Other(FakeEmbedder):
+    key = "test:other"
+
+embedding.use_embedder(Other())
+try:
+    storage.import_notes([{"body": "Second note."}])
+except ValueError:
+    pass
+else:
+    raise AssertionError("imported vectors from another model")
+with storage.reader() as conn:
+    assert conn.execute("SELECT emb_model, COUNT(*) FROM notes GROUP BY emb_model").fetchall() == [("test:fake", 1)]
+""")
@@ -0,0 +1,33 @@
+# Every name the GUI, the Flask backend and the CLI scripts import from brain/ must exist. The modules are
+# imported in a subprocess with a scratch HOME, since storage opens ~/.second-brain at import.
+import ast
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+BRAIN = ROOT / "brain"
+CALLERS = [BRAIN / "gui.py", BRAIN / "importer.py", BRAIN / "reembed.py", ROOT / "frontend" / "integration.py"]
+MODULES = ("storage", "llm", "embedding")
+
+def imported_names():
+    names = set()
+    for path in CALLERS:
+        for node in ast.walk(ast.parse(path.read_text(encoding="utf-8"))):
+            if isinstance(node, ast.ImportFrom) and node.module in MODULES:
+                names.update((node.module, alias.name) for alias in node.names)
+    return sorted(names)
+
+def test_imported_names_exist(tmp_path):
+    names = imported_names()
+    assert ("storage", "get_note") in names
+    script = (
+        "import importlib, sys\n"
+        f"names = {names!r}\n"
+        "missing = [f'{m}.{n}' for m, n in names if not hasattr(importlib.import_module(m), n)]\n"
+        "import importer, reembed, bench_storage\n"
+        "sys.exit('missing: ' + ', '.join(missing) if missing else 0)\n"
+    )
+    out = subprocess.run([sys.executable, "-c", script], cwd=BRAIN, capture_output=True, text=True, timeout=120,
+                         env={"HOME": str(tmp_path), "PATH": "/usr/bin:/bin", "PYTHONPATH": str(BRAIN)})
+    assert out.returncode == 0, out.stderr
@@ -0,0 +1,68 @@
+# Chunking, listing, tag filters and the result caches in storage
+
+def test_chunks_round_trip_through_join(run_brain):
+    run_brain("""
+import storage
+text = " ".join(f"Sentence number {i} is about rivers and their banks." for i in range(300))
+chunks = list(storage._chunk(text))
+assert len(chunks) > 2 and chunks[0][0] == 0 and chunks[-1][1] == len(text)
+assert all(len(storage._TOKEN.findall(text[s:e])) <= storage.CHUNK_TOKENS for s, e in chunks)
+assert any(start < end for (_, end), (start, _) in zip(chunks, chunks[1:])), "chunks should overlap"
+assert all(prev_start < start for (prev_start, _), (start, _) in zip(chunks, chunks[1:]))
+assert storage._join_chunks([(text[s:e], s, e) for s, e in chunks]) == text
+storage.add(text, "rivers")
+assert storage.note_text(1) == text
+""")
+
+def test_cursor_paging_over_equal_timestamps(run_brain):
+    run_brain("""
+import storage
+storage.import_notes([{"body": f"Note {i}.", "timestamp": 1000 + i // 4} for i in range(23)])
+seen, cursor = [], None
+while True:
+    page = storage.filter_notes(limit=5, cursor=cursor)
+    if not page:
+        break
+    seen.extend(row[0] for row in page)
+    cursor = storage.encode_cursor(page[-1])
+assert sorted(seen) == list(range(1, 24)), seen
+assert seen == [row[0] for row in storage.filter_notes()]
+""")
+
+def test_tag_filter_matches_whole_tags(run_brain):
+    run_brain("""
+import storage
+storage.add("Notes on large language models.", "ai,research")
+storage.add("Reply to the landlord.", "email")
+storage.add("Weekend plans.", "")
+assert [row[0] for row in storage.filter_notes(tags="ai")] == [1]
+assert [row[0] for row in storage.filter_notes(tags="email")] == [2]
+assert [nid for nid, _ in storage.topk("notes reply plans", k=5, tags="ai")] == [1]
+""")
+
+def test_topk_cache_sees_every_write(run_brain):
+    run_brain("""
+import storage
+storage.add("The heron stood in the shallows.", "birds")
+assert [nid for nid, _ in storage.topk("heron", k=5)] == [1]
+storage.add("A second heron flew over.", "birds")
+assert sorted(nid for nid, _ in storage.topk("heron", k=5)) == [1, 2]
+storage.update_note(1, "The egret stood in the shallows.", "birds")
+hits = storage.topk("heron", k=5)
+assert hits[0] == (2, "A second heron flew over.") and (1, "The heron stood in the shallows.") not in hits
+storage.delete(2)
+assert 2 not in [nid for nid, _ in storage.topk("heron", k=5)]
+""")
+
+def test_answer_cache_drops_entries_citing_an_edited_note(run_brain):
+    run_brain("""
+import storage
+storage.add("The spare key is under the blue pot.", "home")
+storage.add("The wifi password is on the router.", "home")
+ctx = [(1, "The spare key is under the blue pot."), (2, "The wifi password is on the router.")]
+storage.store_answer("where is the spare key", ctx, "Under the blue pot [[1]].")
+assert storage.cached_answer("where is the spare key", ctx) == "Under the blue pot [[1]]."
+storage.update_note(1, "The spare key is with the neighbour.", "home")
+assert storage.answer_cache_stats()["entries"] == 0
+assert storage.cached_answer("where is the spare key", ctx) is None
+""")
@@ -0,0 +1,45 @@
+# Re-encoding notes.emb into another vector format (migrate_vectors)
+
+SEED = """
+import storage
+storage.import_notes([{"body": f"note {i} about herons."} for i in range(5)], batch_size=1)
+def stored(codec):
+    with storage.reader() as conn:
+        return [storage._decode(blob, codec) for (blob,) in conn.execute("SELECT emb FROM notes ORDER BY id")]
+before = stored("float32")
+"""
+
+def test_interrupted_migration_leaves_the_old_format(run_brain):
+    run_brain(SEED + """
+real, calls = storage._encode, [0]
+def crash_after_two(vec, codec=None):
+    calls[0] += 1
+    if calls[0] > 2:
+        raise RuntimeError("interrupted")
+    return real(vec, codec)
+storage._encode = crash_after_two
+try:
+    storage.migrate_vectors("float16", batch=2)
+except RuntimeError:
+    pass
+storage._encode = real
+assert storage._get_setting("vector_format", {"codec": "float32", "dims": 0})["codec"] == "float32"
+assert all(np.array_equal(a, b) for a, b in zip(stored("float32"), before))
+assert storage.migrate_vectors("float16", batch=2) == 5
+assert all(np.allclose(a, b, atol=1e-3) for a, b in zip(stored("float16"), before))
+""")
+
+def test_migration_refuses_to_grow_dimensions(run_brain):
+    run_brain(SEED + """
+storage.migrate_vectors("float32", dims=8)
+assert {v.size for v in stored("float32")} == {8}
+for dims in (12, 0):
+    try:
+        storage.migrate_vectors("float32", dims=dims)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError(f"migrated 8-dimension vectors to dims={dims}")
+assert storage._get_setting("vector_format") == {"codec": "float32", "dims": 8}
+assert {v.size for v in stored("float32")} == {8}
+""")